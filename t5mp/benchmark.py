@@ -0,0 +1,249 @@
+import os
+import time
+import tracemalloc
+
+import click
+import numpy as np
+from datasets import load_dataset
+from transformers import AutoTokenizer
+from transformers.models.t5.modeling_flax_t5 import shift_tokens_right
+
+from t5mp.input_pipeline import noise_rng_key
+from t5mp.packing import count_tokens, encode_texts, native_tokenizer
+from t5mp.sampling import BlockShufflePermutation, FeistelPermutation, LazyBatchSplits
+from t5mp.token_store import TokenStore
+from t5mp.run_t5_mlm_flax import (
+    FlaxDataCollatorForT5MLM,
+    compute_input_and_target_lengths,
+)
+
+
+def _int_list(ctx, param, value):
+    return [int(v) for v in value.split(",")]
+
+
+def measure(fn, repeats):
+    """Returns the calls per second of `fn` over `repeats` calls and the peak memory allocated by one call."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return repeats / elapsed, peak
+
+
+@click.group()
+def benchmark():
+    """Micro-benchmarks of the host-side data path."""
+
+
+@benchmark.command("collator")
+@click.option("--tokenizer-name", default="./t5mumo")
+@click.option("--batch-sizes", default="8,64,256", callback=_int_list)
+@click.option("--seq-lengths", default="128,256,512,1024,2048", callback=_int_list)
+@click.option("--mlm-probability", type=float, default=0.15)
+@click.option("--mean-noise-span-length", type=float, default=3.0)
+@click.option("--repeats", type=int, default=20)
+@click.option("--seed", type=int, default=42)
+def benchmark_collator(
+    tokenizer_name,
+    batch_sizes,
+    seq_lengths,
+    mlm_probability,
+    mean_noise_span_length,
+    repeats,
+    seed,
+):
+    """
+    Times the steps of FlaxDataCollatorForT5MLM on random token ids and reports batches/sec and the peak memory
+    allocated per batch. Runs on the CPU only, no accelerator is involved.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    np.random.seed(seed)
+
+    click.echo(
+        f"{'function':<32} {'batch':>6} {'length':>7} {'batches/s':>12} {'peak MiB':>10}"
+    )
+    for seq_length in seq_lengths:
+        expanded_inputs_length, targets_length = compute_input_and_target_lengths(
+            inputs_length=seq_length,
+            noise_density=mlm_probability,
+            mean_noise_span_length=mean_noise_span_length,
+        )
+        data_collator = FlaxDataCollatorForT5MLM(
+            tokenizer=tokenizer,
+            noise_density=mlm_probability,
+            mean_noise_span_length=mean_noise_span_length,
+            input_length=seq_length,
+            target_length=targets_length,
+            pad_token_id=tokenizer.pad_token_id,
+            decoder_start_token_id=tokenizer.pad_token_id,
+        )
+        for batch_size in batch_sizes:
+            input_ids = np.random.randint(
+                len(tokenizer) // 2,
+                size=(batch_size, expanded_inputs_length),
+                dtype=np.int32,
+            )
+            mask_indices = data_collator.random_spans_noise_mask_batch(
+                batch_size, expanded_inputs_length
+            )
+            sentinel_ids = data_collator.create_sentinel_ids(
+                mask_indices.astype(np.int8)
+            )
+            labels = data_collator.create_inputs_and_labels(input_ids, mask_indices)[
+                "labels"
+            ]
+            rng_key = noise_rng_key(seed, 0, 0)
+
+            cases = {
+                "random_spans_noise_mask": lambda: [
+                    data_collator.random_spans_noise_mask(expanded_inputs_length)
+                    for _ in range(batch_size)
+                ],
+                "random_spans_noise_mask_batch": lambda: data_collator.random_spans_noise_mask_batch(
+                    batch_size, expanded_inputs_length, rng_key=rng_key
+                ),
+                "create_sentinel_ids": lambda: data_collator.create_sentinel_ids(
+                    mask_indices.astype(np.int8)
+                ),
+                "filter_input_ids": lambda: data_collator.filter_input_ids(
+                    input_ids, sentinel_ids
+                ),
+                "create_inputs_and_labels": lambda: data_collator.create_inputs_and_labels(
+                    input_ids, mask_indices
+                ),
+                "shift_tokens_right": lambda: shift_tokens_right(
+                    labels, tokenizer.pad_token_id, tokenizer.pad_token_id
+                ),
+                "__call__": lambda: data_collator(input_ids, rng_key=rng_key),
+            }
+            for name, fn in cases.items():
+                batches_per_second, peak = measure(fn, repeats)
+                click.echo(
+                    f"{name:<32} {batch_size:>6} {seq_length:>7} {batches_per_second:>12.1f} {peak / 2**20:>10.2f}"
+                )
+
+
+@benchmark.command("tokenization")
+@click.option("--tokenizer-name", default="./t5mumo")
+@click.option("--dataset-name", default="wikitext")
+@click.option("--dataset-config-name", default="wikitext-103-v1")
+@click.option("--num-texts", type=int, default=200000)
+@click.option("--num-proc", type=int, default=None)
+@click.option("--batch-size", type=int, default=10000)
+def benchmark_tokenization(
+    tokenizer_name, dataset_name, dataset_config_name, num_texts, num_proc, batch_size
+):
+    """
+    Tokenizes the first `--num-texts` texts of the train split of a dataset through `datasets.map` on `--num-proc`
+    processes, as `tokenize_and_pack` does, and with the native batch encoder, as `encode_and_pack` does, and reports
+    the throughput of both.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    dataset = load_dataset(dataset_name, dataset_config_name, split="train")
+    dataset = dataset.select(range(min(num_texts, len(dataset))))
+    text_column_name = (
+        "text" if "text" in dataset.column_names else dataset.column_names[0]
+    )
+
+    def tokenize_function(examples):
+        return tokenizer(examples[text_column_name], return_attention_mask=False)
+
+    start = time.perf_counter()
+    tokenized_dataset = dataset.map(
+        tokenize_function,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        load_from_cache_file=False,
+    )
+    map_time = time.perf_counter() - start
+    map_tokens = count_tokens(tokenized_dataset.data.column("input_ids"))
+
+    start = time.perf_counter()
+    backend_tokenizer = native_tokenizer(tokenizer)
+    texts = dataset.with_format("arrow")
+    native_tokens = 0
+    for i in range(0, len(dataset), batch_size):
+        batch = texts[i : i + batch_size].column(text_column_name).to_pylist()
+        native_tokens += len(encode_texts(backend_tokenizer, batch))
+    native_time = time.perf_counter() - start
+
+    click.echo(
+        f"{'path':<24} {'seconds':>9} {'texts/s':>12} {'tokens/s':>14} {'tokens':>12}"
+    )
+    for name, elapsed, num_tokens in (
+        ("datasets.map", map_time, map_tokens),
+        ("encode_batch", native_time, native_tokens),
+    ):
+        click.echo(
+            f"{name:<24} {elapsed:>9.2f} {len(dataset) / elapsed:>12.1f} {num_tokens / elapsed:>14.1f} {num_tokens:>12}"
+        )
+
+
+def evict_from_page_cache(path):
+    """Drops the cached pages of the file at `path`, so that the next reads hit the storage."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+@benchmark.command("shuffle-read")
+@click.option("--token-store", required=True)
+@click.option("--split", default="train")
+@click.option("--batch-size", type=int, default=256)
+@click.option("--num-batches", type=int, default=500)
+@click.option("--block-sizes", default="64,256,1024,4096", callback=_int_list)
+@click.option("--window-blocks", type=int, default=16)
+@click.option("--evict-cache/--no-evict-cache", default=True)
+@click.option("--seed", type=int, default=42)
+def benchmark_shuffle_read(
+    token_store,
+    split,
+    batch_size,
+    num_batches,
+    block_sizes,
+    window_blocks,
+    evict_cache,
+    seed,
+):
+    """
+    Reads `--num-batches` shuffled batches from a token store, as the training loop does, with a full shuffle and with
+    a block shuffle of every `--block-sizes`, and reports the read throughput of each. The pages of the store are
+    evicted from the page cache before every run, so the reads hit the storage (Linux only, pass
+    `--no-evict-cache` elsewhere).
+    """
+    store = TokenStore(token_store, split)
+    path = os.path.join(token_store, f"{split}.bin")
+    row_bytes = store.sequence_length * store.tokens.dtype.itemsize
+    permutations = {"full shuffle": FeistelPermutation(len(store), seed)}
+    for block_size in block_sizes:
+        permutations[f"blocks of {block_size}"] = BlockShufflePermutation(
+            len(store), block_size, window_blocks, seed
+        )
+
+    click.echo(
+        f"{'shuffle':<24} {'seconds':>9} {'batches/s':>12} {'rows/s':>12} {'MiB/s':>10}"
+    )
+    for name, permutation in permutations.items():
+        batches = LazyBatchSplits(permutation, batch_size)
+        steps = range(min(num_batches, len(batches)))
+        if evict_cache:
+            evict_from_page_cache(path)
+        start = time.perf_counter()
+        for step in steps:
+            store.fetch(batches.batch(step))
+        elapsed = time.perf_counter() - start
+        num_rows = len(steps) * batch_size
+        click.echo(
+            f"{name:<24} {elapsed:>9.2f} {len(steps) / elapsed:>12.1f} {num_rows / elapsed:>12.1f}"
+            f" {num_rows * row_bytes / elapsed / 2**20:>10.1f}"
+        )
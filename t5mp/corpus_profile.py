@@ -0,0 +1,79 @@
+"""Document length statistics of a tokenized corpus and what packing or cutting it into sequences costs."""
+import numpy as np
+
+
+class LengthProfile:
+    """
+    Counts of the token lengths of the documents of a corpus, updated batch by batch so that a corpus can be
+    profiled as a stream. The counts are kept per exact length, so the costs of any sequence length are computed
+    exactly without going over the corpus again.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, lengths):
+        """Adds the documents of `lengths` tokens to the profile."""
+        counts = np.bincount(np.asarray(lengths, dtype=np.int64))
+        if len(counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(counts) - len(self.counts)))
+        self.counts[: len(counts)] += counts
+
+    @property
+    def num_documents(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def num_tokens(self) -> int:
+        return int(np.dot(self.counts, np.arange(len(self.counts))))
+
+    def percentile(self, q) -> int:
+        """Smallest length at least `q` percent of the documents are not longer than."""
+        cumulative = np.cumsum(self.counts)
+        return int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+
+    def histogram(self):
+        """
+        Number of documents and of tokens by power of two length bins: `(low, high, documents, tokens)` for the
+        documents of `low <= length < high` tokens, empty documents in the first bin.
+        """
+        lengths = np.arange(len(self.counts))
+        bins = []
+        low = 0
+        while low < len(self.counts):
+            high = max(2 * low, 1)
+            counts = self.counts[low:high]
+            bins.append(
+                (
+                    low,
+                    high,
+                    int(counts.sum()),
+                    int(np.dot(counts, lengths[low:high])),
+                )
+            )
+            low = high
+        return bins
+
+    def packing_dropped_tokens(self, length, num_streams=1) -> int:
+        """
+        Tokens thrown away when packing the documents back to back into rows of `length` (see `StreamingPacker`),
+        the tail of the stream. With `num_streams` (e.g. one per preprocessing worker), this is an estimate
+        assuming every stream drops half a row on average.
+        """
+        if num_streams == 1:
+            return self.num_tokens % length
+        return min(self.num_tokens, num_streams * (length - 1) // 2)
+
+    def chunking_dropped_tokens(self, length) -> int:
+        """Tokens thrown away when cutting every document on its own into rows of `length`, the tail of each one."""
+        lengths = np.arange(len(self.counts))
+        return int(np.dot(self.counts, lengths % length))
+
+    def padding_efficiency(self, length) -> float:
+        """
+        Share of real tokens in the rows of `length` when every document is cut on its own and its last row is
+        padded instead of dropped.
+        """
+        lengths = np.arange(len(self.counts))
+        num_rows = np.dot(self.counts, -(-lengths // length))
+        return self.num_tokens / max(num_rows * length, 1)
@@ -0,0 +1,404 @@
+"""Exact and near-duplicate removal over sharded text files, one document per line."""
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import zlib
+from itertools import islice
+
+import click
+import numpy as np
+from transformers import AutoTokenizer
+
+from t5mp.packing import encode_lengths, native_tokenizer
+from t5mp.token_store import check_replaceable
+
+# documents are identified by their shard and their line in the shard, packed as `shard << _LINE_BITS | line` so
+# that sorting ids sorts documents in corpus order
+_LINE_BITS = 40
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_KEY_DTYPE = np.dtype([("key", np.uint64), ("id", np.uint64)])
+
+
+class MinHasher:
+    """
+    MinHash signatures of the sets of word n-grams of documents and their locality-sensitive hashing band keys. Two
+    documents share the key of a band when `num_perm // bands` consecutive values of their signatures are equal,
+    which happens for at least one of the `bands` with a probability rising steeply around a Jaccard similarity of
+    `threshold`. Documents of less than `ngram` words have no n-gram and no signature.
+    """
+
+    def __init__(self, num_perm=128, bands=16, ngram=5, seed=42):
+        if num_perm % bands:
+            raise ValueError(
+                f"The number of permutations ({num_perm}) must be a multiple of the number of bands ({bands})."
+            )
+        self.num_perm = num_perm
+        self.bands = bands
+        self.ngram = ngram
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    @property
+    def threshold(self) -> float:
+        """Jaccard similarity at which two documents share a band key with probability about 1/2."""
+        return (1 / self.bands) ** (self.bands / self.num_perm)
+
+    def ngram_hashes(self, documents):
+        """32-bit hashes of the word n-grams of `documents`, and the document of every n-gram."""
+        words = [document.split() for document in documents]
+        word_counts = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        word_hashes = np.fromiter(
+            (zlib.crc32(word.encode()) for document in words for word in document),
+            dtype=np.uint64,
+            count=word_counts.sum(),
+        )
+        word_documents = np.repeat(np.arange(len(documents)), word_counts)
+
+        num_ngrams = max(len(word_hashes) - self.ngram + 1, 0)
+        hashes = np.zeros(num_ngrams, dtype=np.uint64)
+        for offset in range(self.ngram):
+            hashes = hashes * _MIX + word_hashes[offset : offset + num_ngrams]
+        # n-grams spanning two documents are dropped
+        within = (
+            word_documents[:num_ngrams]
+            == word_documents[self.ngram - 1 : self.ngram - 1 + num_ngrams]
+        )
+        hashes = (hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+        return hashes[within], word_documents[:num_ngrams][within]
+
+    def signatures(self, documents, chunk_size=1 << 16):
+        """
+        MinHash signatures of `documents`, of shape `[len(documents), num_perm]`, and whether every document has
+        n-grams. The n-grams are hashed `chunk_size` at a time, so long documents take bounded memory.
+        """
+        hashes, hash_documents = self.ngram_hashes(documents)
+        signatures = np.full(
+            (len(documents), self.num_perm), _MERSENNE_PRIME, dtype=np.uint64
+        )
+        for start in range(0, len(hashes), chunk_size):
+            chunk_documents = hash_documents[start : start + chunk_size]
+            values = (
+                hashes[start : start + chunk_size, None] * self.a % _MERSENNE_PRIME
+                + self.b
+            ) % _MERSENNE_PRIME
+            starts = np.flatnonzero(
+                np.r_[True, chunk_documents[1:] != chunk_documents[:-1]]
+            )
+            rows = chunk_documents[starts]
+            signatures[rows] = np.minimum(
+                signatures[rows], np.minimum.reduceat(values, starts, axis=0)
+            )
+        has_ngrams = np.zeros(len(documents), dtype=bool)
+        has_ngrams[hash_documents] = True
+        return signatures, has_ngrams
+
+    def band_keys(self, signatures) -> np.ndarray:
+        """64-bit keys of the bands of `signatures`, of shape `[len(signatures), bands]`, distinct across bands."""
+        bands = signatures.reshape((len(signatures), self.bands, -1))
+        keys = np.broadcast_to(
+            np.arange(1, self.bands + 1, dtype=np.uint64), bands.shape[:2]
+        ).copy()
+        for row in range(bands.shape[-1]):
+            keys = keys * _MIX + bands[:, :, row]
+        return keys
+
+
+def exact_hash(document) -> int:
+    """64-bit hash of `document` with its whitespace normalized."""
+    digest = hashlib.blake2b(" ".join(document.split()).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "little")
+
+
+def read_documents(path, batch_size):
+    """Yields the lines of the text file at `path`, without their line breaks, `batch_size` at a time."""
+    with open(path, encoding="utf-8") as f:
+        lines = (line.rstrip("\r\n") for line in f)
+        yield from iter(lambda: list(islice(lines, batch_size)), [])
+
+
+def _hash_shard(task):
+    shard, path, work_dir, hasher, num_partitions, batch_size = task
+    files = {
+        (kind, partition): open(
+            os.path.join(work_dir, f"{partition:04d}", f"{kind}-{shard:05d}.bin"), "wb"
+        )
+        for kind in ("exact", "near")
+        for partition in range(num_partitions)
+    }
+
+    def write(kind, keys, ids):
+        pairs = np.empty(len(keys), dtype=_KEY_DTYPE)
+        pairs["key"], pairs["id"] = keys, ids
+        partitions = keys % np.uint64(num_partitions)
+        for partition in np.unique(partitions).tolist():
+            files[kind, partition].write(pairs[partitions == partition].tobytes())
+
+    num_documents = 0
+    try:
+        for documents in read_documents(path, batch_size):
+            ids = (np.uint64(shard) << np.uint64(_LINE_BITS)) + np.arange(
+                num_documents, num_documents + len(documents), dtype=np.uint64
+            )
+            write(
+                "exact",
+                np.fromiter(map(exact_hash, documents), np.uint64, len(documents)),
+                ids,
+            )
+            signatures, has_ngrams = hasher.signatures(documents)
+            keys = hasher.band_keys(signatures[has_ngrams])
+            write(
+                "near",
+                keys.reshape(-1),
+                np.repeat(ids[has_ngrams], hasher.bands),
+            )
+            num_documents += len(documents)
+    finally:
+        for f in files.values():
+            f.close()
+    return shard, num_documents
+
+
+def _find_duplicates(partition_dir):
+    # within a partition, every document sharing a key with a document earlier in the corpus is a duplicate
+    duplicates = {}
+    for kind in ("exact", "near"):
+        pairs = np.concatenate(
+            [
+                np.fromfile(path, dtype=_KEY_DTYPE)
+                for path in sorted(glob.glob(os.path.join(partition_dir, f"{kind}-*")))
+            ]
+        )
+        pairs = pairs[np.lexsort((pairs["id"], pairs["key"]))]
+        later = pairs["key"][1:] == pairs["key"][:-1]
+        duplicates[kind] = np.unique(pairs["id"][1:][later])
+    shutil.rmtree(partition_dir)
+    return duplicates["exact"], duplicates["near"]
+
+
+def duplicate_masks(ids, num_documents):
+    """
+    Boolean masks of the documents `ids` in every shard, for shards of `num_documents[shard]` documents. The ids are
+    grouped by shard with a single sort, so marking tens of millions of duplicates stays vectorized.
+    """
+    shards = (ids >> np.uint64(_LINE_BITS)).astype(np.int64)
+    lines = (ids & np.uint64((1 << _LINE_BITS) - 1)).astype(np.int64)
+    order = np.argsort(shards, kind="stable")
+    shards, lines = shards[order], lines[order]
+    bounds = np.searchsorted(shards, np.arange(len(num_documents) + 1))
+    masks = []
+    for shard, size in enumerate(num_documents):
+        mask = np.zeros(size, dtype=bool)
+        mask[lines[bounds[shard] : bounds[shard + 1]]] = True
+        masks.append(mask)
+    return masks
+
+
+# set in each worker process by `_init_filter_worker`
+_worker_tokenizer = None
+
+
+def _init_filter_worker(tokenizer_name):
+    global _worker_tokenizer
+    if tokenizer_name is not None:
+        _worker_tokenizer = native_tokenizer(
+            AutoTokenizer.from_pretrained(tokenizer_name)
+        )
+
+
+def _filter_shard(task):
+    path, output_path, exact, near, batch_size = task
+    stats = {
+        unit: dict.fromkeys(("total", "exact_duplicates", "near_duplicates"), 0)
+        for unit in ("documents", "words", "characters", "tokens")
+    }
+    line = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for documents in read_documents(path, batch_size):
+            counts = {
+                "documents": np.ones(len(documents), dtype=np.int64),
+                "words": np.fromiter(
+                    (len(document.split()) for document in documents),
+                    np.int64,
+                    len(documents),
+                ),
+                "characters": np.fromiter(
+                    map(len, documents), np.int64, len(documents)
+                ),
+            }
+            if _worker_tokenizer is not None:
+                counts["tokens"] = encode_lengths(_worker_tokenizer, documents)
+            removed = {
+                "exact_duplicates": exact[line : line + len(documents)],
+                "near_duplicates": near[line : line + len(documents)],
+            }
+            for unit, values in counts.items():
+                stats[unit]["total"] += int(values.sum())
+                for kind, mask in removed.items():
+                    stats[unit][kind] += int(values[mask].sum())
+            kept = ~(removed["exact_duplicates"] | removed["near_duplicates"])
+            f.writelines(
+                document + "\n" for document, keep in zip(documents, kept) if keep
+            )
+            line += len(documents)
+    return stats
+
+
+@click.command("dedup")
+@click.option(
+    "--input",
+    "inputs",
+    multiple=True,
+    required=True,
+    help="Text files or glob patterns of the shards of the corpus, one document per line.",
+)
+@click.option("--output-dir", required=True)
+@click.option("--num-perm", type=int, default=128)
+@click.option("--bands", type=int, default=16)
+@click.option("--ngram", type=int, default=5)
+@click.option("--num-partitions", type=int, default=64)
+@click.option("--num-workers", type=int, default=None)
+@click.option("--batch-size", type=int, default=10000)
+@click.option("--tokenizer-name", default=None)
+@click.option("--seed", type=int, default=42)
+@click.option(
+    "--overwrite/--no-overwrite",
+    default=False,
+    help="Replace `--output-dir` even if it doesn't hold the output of a previous run.",
+)
+def dedup(
+    inputs,
+    output_dir,
+    num_perm,
+    bands,
+    ngram,
+    num_partitions,
+    num_workers,
+    batch_size,
+    tokenizer_name,
+    seed,
+    overwrite,
+):
+    """
+    Removes the exact and near duplicates of the documents of the input shards and writes the other documents to
+    `--output-dir`, one `shard-XXXXX.txt` per input shard, along with `dedup_stats.json`. The first occurrence of a
+    document in the corpus, in the order of the shards, is kept.
+
+    Exact duplicates have the same text up to whitespace. Near duplicates share a MinHash LSH band of their word
+    `--ngram`s with an earlier document, see `MinHasher`. Shards are hashed in parallel into `--num-partitions` files
+    of keys on disk, then every partition is deduplicated on its own, so memory stays bounded by the size of a
+    partition whatever the size of the corpus. Pass `--tokenizer-name` to also count the tokens removed.
+
+    An existing `--output-dir` is only replaced if it holds the `dedup_stats.json` of a previous run, or with
+    `--overwrite`. The output directory can be used as `--train-file "DIR/*.txt"` of `ptlm tokenizer` and
+    `--train_file "DIR/*.txt"` of `ptlm train-model`.
+    """
+    paths = sorted(path for pattern in inputs for path in glob.glob(pattern))
+    if not paths:
+        raise ValueError(f"No input files match {list(inputs)}.")
+    if len(paths) >= 1 << (64 - _LINE_BITS):
+        raise ValueError(f"Too many input shards ({len(paths)}).")
+    check_replaceable(output_dir, "dedup_stats.json", "--overwrite", overwrite)
+    hasher = MinHasher(num_perm=num_perm, bands=bands, ngram=ngram, seed=seed)
+
+    tmp_path = f"{output_dir}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    work_dir = os.path.join(tmp_path, "work")
+    for partition in range(num_partitions):
+        os.makedirs(os.path.join(work_dir, f"{partition:04d}"))
+
+    # workers are spawned rather than forked, like the other multiprocessing stages
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_workers) as pool:
+        num_documents = dict(
+            pool.imap_unordered(
+                _hash_shard,
+                [
+                    (shard, path, work_dir, hasher, num_partitions, batch_size)
+                    for shard, path in enumerate(paths)
+                ],
+            )
+        )
+        exact, near = zip(
+            *pool.imap_unordered(
+                _find_duplicates,
+                [
+                    os.path.join(work_dir, f"{partition:04d}")
+                    for partition in range(num_partitions)
+                ],
+            )
+        )
+    shutil.rmtree(work_dir)
+
+    num_documents = [num_documents[shard] for shard in range(len(paths))]
+    removed = {
+        "exact": duplicate_masks(np.concatenate(exact), num_documents),
+        "near": duplicate_masks(np.concatenate(near), num_documents),
+    }
+    # documents that are exact duplicates are near duplicates too, they are only counted once
+    for shard in range(len(paths)):
+        removed["near"][shard] &= ~removed["exact"][shard]
+
+    with context.Pool(
+        num_workers, initializer=_init_filter_worker, initargs=(tokenizer_name,)
+    ) as pool:
+        shard_stats = pool.map(
+            _filter_shard,
+            [
+                (
+                    path,
+                    os.path.join(tmp_path, f"shard-{shard:05d}.txt"),
+                    removed["exact"][shard],
+                    removed["near"][shard],
+                    batch_size,
+                )
+                for shard, path in enumerate(paths)
+            ],
+        )
+
+    stats = {
+        unit: {
+            kind: sum(shard[unit][kind] for shard in shard_stats)
+            for kind in ("total", "exact_duplicates", "near_duplicates")
+        }
+        for unit in ("documents", "words", "characters", "tokens")
+    }
+    if tokenizer_name is None:
+        del stats["tokens"]
+    for counts in stats.values():
+        counts["kept"] = (
+            counts["total"] - counts["exact_duplicates"] - counts["near_duplicates"]
+        )
+    with open(os.path.join(tmp_path, "dedup_stats.json"), "w") as f:
+        json.dump(
+            {
+                "inputs": paths,
+                "num_perm": num_perm,
+                "bands": bands,
+                "ngram": ngram,
+                "threshold": hasher.threshold,
+                **stats,
+            },
+            f,
+            indent=4,
+        )
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(tmp_path, output_dir)
+
+    click.echo(
+        f"{'':<12} {'total':>14} {'exact dups':>14} {'near dups':>14} {'removed':>9}"
+    )
+    for unit, counts in stats.items():
+        removed_share = (counts["exact_duplicates"] + counts["near_duplicates"]) / max(
+            counts["total"], 1
+        )
+        click.echo(
+            f"{unit:<12} {counts['total']:>14} {counts['exact_duplicates']:>14} {counts['near_duplicates']:>14}"
+            f" {removed_share:>9.2%}"
+        )
@@ -0,0 +1,285 @@
+"""Host-side helpers feeding batches to the span-masked language modeling trainer."""
+import math
+import multiprocessing
+import queue
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from multiprocessing import shared_memory
+
+import jax
+import numpy as np
+
+from t5mp.packing import StreamingPacker, list_column_values
+from t5mp.token_store import TokenStore
+
+# seconds between checks that the collator workers are still alive while waiting for a batch, and seconds a worker
+# gets to exit on `CollatorPool.close` before it is terminated
+_WORKER_POLL_INTERVAL = 1.0
+_WORKER_JOIN_TIMEOUT = 10.0
+
+
+def noise_rng_key(seed, epoch, step):
+    """Key of the noise masks of the global batch `step` of `epoch`, see `FlaxDataCollatorForT5MLM.random_sort_keys`."""
+    return np.random.SeedSequence([seed, epoch, step]).generate_state(2, np.uint64)
+
+
+def fetch_input_ids(dataset, indices, column="input_ids") -> np.ndarray:
+    """
+    Gathers the rows `indices` of a fixed-length token column straight from the Arrow table backing `dataset`.
+    The values are taken by index on the Arrow side and flattened into a single contiguous int32 array of shape
+    `[len(indices), sequence_length]`, without decoding rows into Python lists. Rows of a `TokenStore` are
+    gathered from its memory-mapped file instead, and rows of an array of sequences are indexed directly.
+    """
+    if isinstance(dataset, TokenStore):
+        return dataset.fetch(indices)
+    if isinstance(dataset, np.ndarray):
+        return dataset[indices]
+    indices = np.asarray(indices)
+    # the public arrow format goes through the indices mapping of selected or shuffled datasets, and only formats
+    # the gathered rows as a table
+    table = dataset.with_format("arrow", columns=[column])[indices]
+    values = list_column_values(table.column(column))
+    return np.asarray(values, dtype=np.int32).reshape((len(indices), -1))
+
+
+def packed_sequences(texts, tokenizer, length, batch_size=1000):
+    """
+    Tokenizes the iterable of `texts` `batch_size` texts at a time and yields the token ids packed into rows of
+    `length` by a `StreamingPacker`, so every token but the tail of the stream ends up in exactly one row.
+    """
+    texts = iter(texts)
+    packer = StreamingPacker(length)
+    for batch in iter(lambda: list(islice(texts, batch_size)), []):
+        input_ids = tokenizer(batch, return_attention_mask=False)["input_ids"]
+        values = np.fromiter(chain.from_iterable(input_ids), dtype=np.int32)
+        yield from packer.pack({"input_ids": values})["input_ids"]
+
+
+def shuffle_buffer(iterable, buffer_size, rng):
+    """
+    Yields the items of `iterable` in a random order drawn from `rng`, holding at most `buffer_size` items: each new
+    item takes the place of a random item of the full buffer, which is yielded.
+    """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randint(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def stack_batches(sequences, batch_size):
+    """Stacks consecutive `sequences` into `[batch_size, length]` arrays, dropping the last incomplete batch."""
+    sequences = iter(sequences)
+    for batch in iter(lambda: list(islice(sequences, batch_size)), []):
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+
+
+def prefetch(iterable, fn, depth, num_workers=1):
+    """
+    Applies `fn` to the items of `iterable` on a pool of `num_workers` background threads and yields the results in
+    order, keeping up to `depth` items in flight ahead of the consumer. Collation is mostly numpy code releasing the
+    GIL, so the next batches get prepared while the accelerator runs the current step.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def device_put_batch(batch, devices=None):
+    """
+    Copies a sharded host batch (leading axis over the local devices) to the devices and waits for the transfer to
+    finish, so that the host buffers backing `batch` can be overwritten right after.
+    """
+    devices = jax.local_devices() if devices is None else devices
+    return jax.block_until_ready(
+        jax.tree_util.tree_map(
+            lambda x: jax.device_put_sharded(list(x), devices), batch
+        )
+    )
+
+
+def _ring_slots(buffer, shapes, ring_size):
+    """Splits a shared-memory `buffer` into `ring_size` dicts of int32 arrays with the given `shapes`."""
+    slots, offset = [], 0
+    for _ in range(ring_size):
+        slot = {}
+        for key, shape in shapes.items():
+            slot[key] = np.ndarray(shape, dtype=np.int32, buffer=buffer, offset=offset)
+            offset += slot[key].nbytes
+        slots.append(slot)
+    return slots
+
+
+def _collator_worker(
+    shm_name, shapes, ring_size, dataset, collator, seed, row_offset, tasks, done
+):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = _ring_slots(shm.buf, shapes, ring_size)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, step, slot, batch_idx = task
+        try:
+            collator(
+                fetch_input_ids(dataset, batch_idx),
+                out=slots[slot],
+                rng_key=noise_rng_key(seed, epoch, step),
+                row_offset=row_offset,
+            )
+            done.put((step, slot, None))
+        except Exception:
+            done.put((step, slot, traceback.format_exc()))
+    del slots
+    shm.close()
+
+
+class CollatorPool:
+    """
+    Collates batches of `dataset` with `collator` on `num_workers` processes. Finished batches are written into a
+    ring of `ring_size` shared-memory slots and handed to the trainer as numpy views on those slots, in step order.
+    Noise masks are keyed by `(seed, epoch, step)` and the row in the global batch, so batches are the same whatever
+    the number of workers. A yielded batch stays valid until the next one is requested, copy it (e.g. with `device_put_batch`)
+    before moving on.
+
+    Args:
+        dataset (:class:`~datasets.Dataset`):
+            The grouped dataset, rows are gathered with `fetch_input_ids`.
+        collator (:class:`FlaxDataCollatorForT5MLM`):
+            The collator, its `input_length` and `target_length` fix the shapes of the slots.
+        batch_size (:obj:`int`):
+            Number of rows in each batch.
+        num_workers (:obj:`int`):
+            Number of collating processes.
+        ring_size (:obj:`int`):
+            Number of batches that can be in flight at once.
+        seed (:obj:`int`):
+            Seed the per-step noise masks are derived from.
+        row_offset (:obj:`int`):
+            Position of the collated rows in the global batches when a host only collates its own slice.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        collator,
+        batch_size,
+        num_workers=2,
+        ring_size=4,
+        seed=0,
+        row_offset=0,
+    ):
+        self.ring_size = ring_size
+        shapes = {
+            "input_ids": (batch_size, collator.input_length),
+            "labels": (batch_size, collator.target_length),
+            "decoder_input_ids": (batch_size, collator.target_length),
+        }
+        slot_size = sum(4 * math.prod(shape) for shape in shapes.values())
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_size * ring_size)
+        self._slots = _ring_slots(self._shm.buf, shapes, ring_size)
+
+        # workers are spawned rather than forked, forking a process that already initialized jax is unsafe
+        context = multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._done = context.Queue()
+        self._workers = [
+            context.Process(
+                target=_collator_worker,
+                args=(
+                    self._shm.name,
+                    shapes,
+                    ring_size,
+                    dataset,
+                    collator,
+                    seed,
+                    row_offset,
+                    self._tasks,
+                    self._done,
+                ),
+                daemon=True,
+            )
+            for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def iterate(self, batch_idx, epoch=0):
+        """Yields the collated batches for the index blocks `batch_idx` (see `generate_batch_splits`) in order."""
+        tasks = iter(enumerate(batch_idx))
+        free_slots = deque(range(self.ring_size))
+        ready = {}
+        in_flight = 0
+        released = None
+        try:
+            for step in range(len(batch_idx)):
+                if released is not None:
+                    free_slots.append(released)
+                while free_slots:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    self._tasks.put((epoch, task[0], free_slots.popleft(), task[1]))
+                    in_flight += 1
+                while step not in ready:
+                    done_step, slot, error = self._get_done()
+                    in_flight -= 1
+                    if error is not None:
+                        raise RuntimeError(
+                            f"Collating batch {done_step} failed in a worker:\n{error}"
+                        )
+                    ready[done_step] = slot
+                released = ready.pop(step)
+                yield self._slots[released]
+        finally:
+            # wait for the batches still being collated so that they don't leak into the next iteration
+            try:
+                for _ in range(in_flight):
+                    self._get_done()
+            except RuntimeError:
+                # a worker died, its batches never come and the next `iterate` raises again
+                pass
+
+    def _get_done(self):
+        # a worker killed by the OS (out of memory, crash in native code) never reports back, so rather than
+        # blocking on the queue, poll it and raise once a worker is gone
+        while True:
+            try:
+                return self._done.get(timeout=_WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                for worker in self._workers:
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            f"A collator worker exited unexpectedly with exit code {worker.exitcode}."
+                        )
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(_WORKER_JOIN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._slots = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,9 +2,16 @@ import logging
 
 import click
 
+from t5mp.benchmark import benchmark
 from t5mp.configuration import generate_configuration
+from t5mp.dedup import dedup
 from t5mp.tokenizer import train_tokenizer
-from t5mp.run_t5_mlm_flax import train_model
+from t5mp.run_t5_mlm_flax import (
+    pre_mask,
+    profile_corpus,
+    train_model,
+    write_token_store,
+)
 
 
 logging.basicConfig(
@@ -19,8 +26,13 @@ def cli():
 
 
 cli.add_command(generate_configuration)
+cli.add_command(dedup)
 cli.add_command(train_tokenizer)
 cli.add_command(train_model)
+cli.add_command(write_token_store)
+cli.add_command(pre_mask)
+cli.add_command(profile_corpus)
+cli.add_command(benchmark)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+_MAP_NAMES = (
+    "input_positions",
+    "input_sentinels",
+    "label_positions",
+    "label_sentinels",
+)
+
+
+class SpanMaskBank:
+    """
+    Bank of pregenerated span noise masks stored as memory-mapped index maps (see
+    `FlaxDataCollatorForT5MLM.create_index_maps`). Masks only depend on the sequence length, `noise_density` and
+    `mean_noise_span_length`, so with a bank the collator only has to pick rows and gather tokens.
+
+    The bank is a directory holding one `.npy` file per index map and a `bank.json` with the parameters it was
+    generated with. Pickling only carries the path, so the bank can be shipped to collator worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "bank.json")) as f:
+            self.meta = json.load(f)
+        self.index_maps = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in _MAP_NAMES
+        }
+
+    def __len__(self):
+        return self.meta["num_masks"]
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def check_compatible(self, collator, length):
+        """Raises if the bank was not generated for sequences of `length` corrupted by `collator`."""
+        expected = {
+            "length": length,
+            "noise_density": collator.noise_density,
+            "mean_noise_span_length": collator.mean_noise_span_length,
+            "input_length": collator.input_length,
+            "target_length": collator.target_length,
+        }
+        mismatches = {
+            key: (self.meta[key], value)
+            for key, value in expected.items()
+            if self.meta[key] != value
+        }
+        if mismatches:
+            raise ValueError(
+                f"Span mask bank {self.path} does not match the data collator, (bank, collator) values: {mismatches}."
+            )
+
+    def take(self, rows):
+        """Index maps of the masks `rows`, read in increasing order to stay friendly with the page cache."""
+        order = np.argsort(rows)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return {
+            name: index_map[rows[order]][inverse]
+            for name, index_map in self.index_maps.items()
+        }
+
+    @classmethod
+    def build(cls, path, collator, length, num_masks, seed=0, chunk_size=4096):
+        """
+        Generates `num_masks` masks for sequences of `length` tokens with `collator` and writes their index maps to
+        `path`. Masks are keyed by `seed` and their row in the bank, so the same arguments always produce the same
+        bank. The bank is written next to `path` first and moved in place once complete.
+        """
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        # sentinel numbers and positions both stay far below 2**15 for any realistic sequence length
+        position_dtype = np.int16 if length <= np.iinfo(np.int16).max else np.int32
+        shapes = {
+            "input_positions": (num_masks, collator.input_length - 1),
+            "input_sentinels": (num_masks, collator.input_length - 1),
+            "label_positions": (num_masks, collator.target_length - 1),
+            "label_sentinels": (num_masks, collator.target_length - 1),
+        }
+        index_maps = {
+            name: np.lib.format.open_memmap(
+                os.path.join(tmp_path, f"{name}.npy"),
+                mode="w+",
+                dtype=position_dtype,
+                shape=shape,
+            )
+            for name, shape in shapes.items()
+        }
+
+        rng_key = np.random.SeedSequence(seed).generate_state(2, np.uint64)
+        for start in range(0, num_masks, chunk_size):
+            stop = min(start + chunk_size, num_masks)
+            mask_indices = collator.random_spans_noise_mask_batch(
+                stop - start, length, rng_key=rng_key, row_offset=start
+            )
+            for name, values in collator.create_index_maps(mask_indices).items():
+                index_maps[name][start:stop] = values
+        for index_map in index_maps.values():
+            index_map.flush()
+        del index_maps
+
+        with open(os.path.join(tmp_path, "bank.json"), "w") as f:
+            json.dump(
+                {
+                    "length": length,
+                    "noise_density": collator.noise_density,
+                    "mean_noise_span_length": collator.mean_noise_span_length,
+                    "input_length": collator.input_length,
+                    "target_length": collator.target_length,
+                    "num_masks": num_masks,
+                    "seed": seed,
+                },
+                f,
+                indent=4,
+            )
+        os.rename(tmp_path, path)
+        return cls(path)
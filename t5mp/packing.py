@@ -0,0 +1,194 @@
+"""Packing of tokenized documents into fixed-length sequences."""
+from itertools import chain
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+from tokenizers import Tokenizer
+
+
+def _chunks(column):
+    return column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+
+
+def list_column_values(column) -> np.ndarray:
+    """Flat values of an Arrow list column (array or chunked array) as a numpy array, without Python lists."""
+    values = pa.chunked_array(
+        [chunk.flatten() for chunk in _chunks(column)], type=column.type.value_type
+    )
+    return values.to_numpy()
+
+
+def count_tokens(column) -> int:
+    """Number of values in an Arrow list column, read from the list offsets only."""
+    return sum(
+        int(offsets[-1] - offsets[0])
+        for offsets in (chunk.offsets.to_numpy() for chunk in _chunks(column))
+        if len(offsets)
+    )
+
+
+def list_column_lengths(column) -> np.ndarray:
+    """Lengths of the lists of an Arrow list column, read from the list offsets only."""
+    return np.concatenate(
+        [np.diff(chunk.offsets.to_numpy()) for chunk in _chunks(column)]
+    )
+
+
+def bucket_chunk_starts(document_lengths: np.ndarray, lengths) -> List[np.ndarray]:
+    """
+    Cuts consecutive documents of `document_lengths` tokens into chunks of the bucket `lengths`: every document takes
+    as many chunks of the longest bucket as fit, then of the next longest bucket in what is left, and so on. What is
+    left after the shortest bucket is dropped, so less than the shortest bucket length is lost per document and no
+    chunk spans two documents. Returns, for every bucket, the token offsets of its chunks in the concatenated
+    documents.
+    """
+    document_lengths = np.asarray(document_lengths, dtype=np.int64)
+    offsets = np.cumsum(document_lengths) - document_lengths
+    remaining = document_lengths.copy()
+    starts = [None] * len(lengths)
+    for bucket in np.argsort(lengths)[::-1]:
+        length = lengths[bucket]
+        counts = remaining // length
+        chunk_documents = np.repeat(np.arange(len(counts)), counts)
+        # position of every chunk among the chunks of its document
+        chunk_ranks = np.arange(len(chunk_documents)) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        starts[bucket] = offsets[chunk_documents] + chunk_ranks * length
+        offsets += counts * length
+        remaining -= counts * length
+    return starts
+
+
+def bucket_dropped_tokens(document_lengths: np.ndarray, lengths) -> np.ndarray:
+    """
+    Number of tokens of every document of `document_lengths` tokens that `bucket_chunk_starts` drops: what is left
+    after its chunks, that is the whole document when it is shorter than the shortest bucket.
+    """
+    remaining = np.asarray(document_lengths, dtype=np.int64)
+    for length in sorted(lengths, reverse=True):
+        remaining = remaining % length
+    return remaining
+
+
+def native_tokenizer(tokenizer) -> Tokenizer:
+    """
+    Copy of the Rust `tokenizers.Tokenizer` behind the fast `tokenizer`, with truncation and padding turned off so that
+    it encodes texts to the same ids as `tokenizer(texts)`.
+    """
+    if not tokenizer.is_fast:
+        raise ValueError(
+            f"{type(tokenizer).__name__} is not backed by the `tokenizers` library, native tokenization needs a fast tokenizer."
+        )
+    backend_tokenizer = Tokenizer.from_str(tokenizer.backend_tokenizer.to_str())
+    backend_tokenizer.no_truncation()
+    backend_tokenizer.no_padding()
+    return backend_tokenizer
+
+
+def encode_texts(backend_tokenizer: Tokenizer, texts) -> np.ndarray:
+    """
+    Flat int32 token ids of `texts`, encoded by `encode_batch` which spreads the batch over the native thread pool of
+    the tokenizer.
+    """
+    encodings = backend_tokenizer.encode_batch(texts)
+    return np.fromiter(
+        chain.from_iterable(encoding.ids for encoding in encodings), dtype=np.int32
+    )
+
+
+def encode_lengths(backend_tokenizer: Tokenizer, texts) -> np.ndarray:
+    """Number of tokens of every text of `texts`, encoded by `encode_batch` like `encode_texts`."""
+    encodings = backend_tokenizer.encode_batch(texts)
+    return np.fromiter(
+        (len(encoding) for encoding in encodings), dtype=np.int64, count=len(encodings)
+    )
+
+
+class StreamingPacker:
+    """
+    Packs the token columns of consecutive Arrow batches into rows of `length`. The tokens left over at the end of
+    a batch are carried over to the next call, so every token ends up in exactly one row except the last
+    `length - 1` tokens at most of the stream, which stay in `remainder`.
+
+    Used as a batched `map` function with `num_proc`, every worker process gets its own copy of the packer and
+    packs its contiguous shard of the dataset as one stream, so at most one remainder is dropped per worker.
+    `tokens_seen` and `tokens_packed` count the tokens of the stream and those that made it into rows, for callers
+    that keep the packer in their own process like `encode_and_pack`. The copies of `map` workers are never sent
+    back, so their counts are lost, count the tokens of the mapped table with `count_tokens` instead.
+
+    With `segment_ids`, the rows also get a `segment_ids` column numbering the documents their tokens come from,
+    from 1 in every row, so that attention can be kept from crossing documents, see `t5mp.segments`.
+    """
+
+    def __init__(self, length: int, segment_ids: bool = False):
+        self.length = length
+        self.segment_ids = segment_ids
+        self.remainder: Dict[str, np.ndarray] = {}
+        self.tokens_seen = 0
+        self.tokens_packed = 0
+        self.documents_seen = 0
+
+    def pack(self, columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Appends the flat token arrays `columns` to the stream and returns the full rows of `length` available."""
+        result = {}
+        for name, values in columns.items():
+            if name in self.remainder:
+                values = np.concatenate([self.remainder[name], values])
+            num_rows = len(values) // self.length
+            result[name] = values[: num_rows * self.length].reshape(
+                (num_rows, self.length)
+            )
+            # copied so that the remainder does not keep the whole batch alive
+            self.remainder[name] = values[num_rows * self.length :].copy()
+
+        if columns:
+            first = next(iter(columns))
+            self.tokens_seen += len(columns[first])
+            self.tokens_packed += result[first].size
+        return result
+
+    def __call__(self, examples: pa.Table) -> Dict[str, np.ndarray]:
+        columns = {
+            name: list_column_values(examples.column(name))
+            for name in examples.column_names
+        }
+        if not self.segment_ids:
+            return self.pack(columns)
+
+        # documents are numbered along the whole stream, then renumbered from 1 in every row
+        document_lengths = list_column_lengths(examples.column("input_ids"))
+        columns["segment_ids"] = np.repeat(
+            np.arange(len(document_lengths), dtype=np.int64) + self.documents_seen,
+            document_lengths,
+        )
+        self.documents_seen += len(document_lengths)
+
+        result = self.pack(columns)
+        result["segment_ids"] = (
+            result["segment_ids"] - result["segment_ids"][:, :1] + 1
+        ).astype(np.int32)
+        return result
+
+
+class DocumentChunker:
+    """
+    Cuts the documents of the token columns of an Arrow batch into rows of the bucket `lengths[bucket]`, see
+    `bucket_chunk_starts`. Documents are never packed together, each bucket only keeps the chunks assigned to it, so
+    one map per bucket splits a tokenized dataset into buckets of fixed-length sequences.
+    """
+
+    def __init__(self, lengths, bucket):
+        self.lengths = list(lengths)
+        self.bucket = bucket
+
+    def __call__(self, examples: pa.Table) -> Dict[str, np.ndarray]:
+        result = {}
+        length = self.lengths[self.bucket]
+        for name in examples.column_names:
+            column = examples.column(name)
+            starts = bucket_chunk_starts(list_column_lengths(column), self.lengths)
+            positions = starts[self.bucket][:, None] + np.arange(length)
+            result[name] = list_column_values(column)[positions]
+        return result
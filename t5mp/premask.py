@@ -0,0 +1,219 @@
+import json
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+from t5mp.input_pipeline import fetch_input_ids, noise_rng_key
+from t5mp.token_store import check_replaceable
+
+_COLUMNS = ("input_ids", "labels", "decoder_input_ids")
+
+# set in each worker process by `_init_premask_worker`
+_worker_datasets = None
+_worker_collator = None
+
+
+def _init_premask_worker(datasets, collator):
+    global _worker_datasets, _worker_collator
+    _worker_datasets = datasets
+    _worker_collator = collator
+
+
+def _premask_rows(task):
+    path, split, epoch, start, stop, seed = task
+    model_inputs = _worker_collator(
+        fetch_input_ids(_worker_datasets[split], np.arange(start, stop)),
+        rng_key=noise_rng_key(seed, epoch, 0),
+        row_offset=start,
+    )
+    for name in _COLUMNS:
+        columns = np.load(
+            os.path.join(path, split, f"epoch-{epoch:03d}", f"{name}.npy"),
+            mmap_mode="r+",
+        )
+        columns[start:stop] = model_inputs[name]
+        columns.flush()
+
+
+class PremaskedDataset:
+    """
+    Span-corrupted examples of one split written by `ptlm pre-mask`. For every epoch, the `input_ids`, `labels` and
+    `decoder_input_ids` of all the packed sequences of the split are stored as memory-mapped `.npy` files in
+    `{split}/epoch-{epoch:03d}/`, and `premask.json` records the number of epochs and sequences of every split and
+    the parameters the examples were corrupted with.
+
+    The noise mask of a sequence only depends on the seed, the epoch and the row of the sequence in the split, so the
+    files are the same whatever the number of processes writing them. Pickling only carries the path.
+    """
+
+    def __init__(self, path, split="train"):
+        self.path = path
+        self.split = split
+        self.meta = self.read_meta(path)
+        if split not in self.meta["splits"]:
+            raise ValueError(
+                f"Pre-masked dataset {path} has no {split} split, available splits: {list(self.meta['splits'])}."
+            )
+        self.epochs = [
+            {
+                name: np.load(
+                    os.path.join(path, split, f"epoch-{epoch:03d}", f"{name}.npy"),
+                    mmap_mode="r",
+                )
+                for name in _COLUMNS
+            }
+            for epoch in range(self.num_epochs)
+        ]
+
+    @staticmethod
+    def read_meta(path):
+        with open(os.path.join(path, "premask.json")) as f:
+            return json.load(f)
+
+    @classmethod
+    def load_splits(cls, path):
+        """All the splits of the pre-masked dataset at `path`, by name."""
+        return {split: cls(path, split) for split in cls.read_meta(path)["splits"]}
+
+    @property
+    def num_epochs(self):
+        return self.meta["splits"][self.split]["num_epochs"]
+
+    def __len__(self):
+        return self.meta["splits"][self.split]["num_sequences"]
+
+    def __getstate__(self):
+        return self.path, self.split
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def check_compatible(self, collator):
+        """Raises if the examples were not corrupted the way `collator` would corrupt them."""
+        expected = {
+            "vocab_size": len(collator.tokenizer),
+            "noise_density": collator.noise_density,
+            "mean_noise_span_length": collator.mean_noise_span_length,
+            "input_length": collator.input_length,
+            "target_length": collator.target_length,
+            "decoder_start_token_id": collator.decoder_start_token_id,
+        }
+        mismatches = {
+            key: (self.meta[key], value)
+            for key, value in expected.items()
+            if self.meta[key] != value
+        }
+        if mismatches:
+            raise ValueError(
+                f"Pre-masked dataset {self.path} does not match the data collator, (dataset, collator) values:"
+                f" {mismatches}."
+            )
+
+    def fetch(self, epoch, indices):
+        """
+        The examples `indices` of `epoch` as int32 arrays, read in increasing order to stay friendly with the page
+        cache. Epochs past the last pre-masked one wrap around.
+        """
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        columns = self.epochs[epoch % self.num_epochs]
+        return {
+            name: values[indices[order]][inverse].astype(np.int32)
+            for name, values in columns.items()
+        }
+
+    @classmethod
+    def write(
+        cls,
+        path,
+        datasets,
+        collator,
+        num_epochs,
+        seed=0,
+        num_workers=None,
+        chunk_size=4096,
+        overwrite=False,
+    ):
+        """
+        Corrupts `num_epochs[split]` epochs of the packed sequences of every split of `datasets` with `collator` and
+        writes them to `path`. Chunks of `chunk_size` sequences are collated on `num_workers` processes (all the cores
+        by default), each writing its rows straight into the memory-mapped files. The dataset is written next to
+        `path` first and moved in place once complete. An existing directory at `path` is only replaced if it is a
+        pre-masked dataset or with `overwrite`, see `check_replaceable`.
+        """
+        check_replaceable(path, "premask.json", "--overwrite_premasked_dir", overwrite)
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+        vocab_size = len(collator.tokenizer)
+        dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+        lengths = {
+            "input_ids": collator.input_length,
+            "labels": collator.target_length,
+            "decoder_input_ids": collator.target_length,
+        }
+        tasks = []
+        splits = {}
+        for split, dataset in datasets.items():
+            num_sequences = len(dataset)
+            for epoch in range(num_epochs[split]):
+                epoch_path = os.path.join(tmp_path, split, f"epoch-{epoch:03d}")
+                os.makedirs(epoch_path)
+                for name, length in lengths.items():
+                    np.lib.format.open_memmap(
+                        os.path.join(epoch_path, f"{name}.npy"),
+                        mode="w+",
+                        dtype=dtype,
+                        shape=(num_sequences, length),
+                    ).flush()
+                tasks.extend(
+                    (
+                        tmp_path,
+                        split,
+                        epoch,
+                        start,
+                        min(start + chunk_size, num_sequences),
+                        seed,
+                    )
+                    for start in range(0, num_sequences, chunk_size)
+                )
+            splits[split] = {
+                "num_epochs": num_epochs[split],
+                "num_sequences": num_sequences,
+            }
+
+        # workers are spawned rather than forked, forking a process that already initialized jax is unsafe
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            num_workers,
+            initializer=_init_premask_worker,
+            initargs=(datasets, collator),
+        ) as pool:
+            for _ in pool.imap_unordered(_premask_rows, tasks):
+                pass
+
+        with open(os.path.join(tmp_path, "premask.json"), "w") as f:
+            json.dump(
+                {
+                    "splits": splits,
+                    "dtype": np.dtype(dtype).name,
+                    "vocab_size": vocab_size,
+                    "noise_density": collator.noise_density,
+                    "mean_noise_span_length": collator.mean_noise_span_length,
+                    "input_length": collator.input_length,
+                    "target_length": collator.target_length,
+                    "decoder_start_token_id": collator.decoder_start_token_id,
+                    "seed": seed,
+                },
+                f,
+                indent=4,
+            )
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        return cls.load_splits(path)
@@ -19,6 +19,9 @@ Pretraining the library models for T5-like span-masked language modeling on a te
 Here is the full list of checkpoints on the hub that can be pretrained by this script:
 https://huggingface.co/models?filter=t5
 """
+import contextlib
+import glob
+import hashlib
 import json
 import logging
 import math
@@ -30,14 +33,21 @@ from dataclasses import asdict, dataclass, field
 
 # You can also adapt this script on your own masked language modeling task. Pointers for this are left as comments.
 from enum import Enum
-from itertools import chain
+from functools import partial
+from itertools import chain, count, islice
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
 import numpy as np
-from datasets import load_dataset
+from datasets import DatasetDict, load_dataset
 from tqdm import tqdm
 
+try:
+    from datasets.distributed import split_dataset_by_node
+except ImportError:
+    # added in datasets 2.8
+    split_dataset_by_node = None
+
 import flax
 import jax
 import jax.numpy as jnp
@@ -46,9 +56,41 @@ from flax import jax_utils, traverse_util
 from flax.jax_utils import pad_shard_unpad
 from flax.training import train_state
 from flax.training.common_utils import get_metrics, onehot, shard
+from jax.experimental import multihost_utils
 from jax.experimental.maps import Mesh
 from jax.experimental.pjit import pjit
+from t5mp.corpus_profile import LengthProfile
+from t5mp.input_pipeline import (
+    CollatorPool,
+    device_put_batch,
+    fetch_input_ids,
+    noise_rng_key,
+    packed_sequences,
+    prefetch,
+    shuffle_buffer,
+    stack_batches,
+)
+from t5mp.mask_bank import SpanMaskBank
+from t5mp.packing import (
+    DocumentChunker,
+    StreamingPacker,
+    bucket_dropped_tokens,
+    count_tokens,
+    encode_lengths,
+    encode_texts,
+    list_column_lengths,
+    native_tokenizer,
+)
+from t5mp.premask import PremaskedDataset
+from t5mp.sampling import (
+    BlockShufflePermutation,
+    FeistelPermutation,
+    LazyBatchSplits,
+    WeightedMixtureBatchSplits,
+)
+from t5mp.segments import segment_logits
 from t5mp.t5_partitions import set_partitions
+from t5mp.token_store import TokenStore, check_replaceable
 from huggingface_hub import Repository
 from transformers import (
     CONFIG_MAPPING,
@@ -62,13 +104,14 @@ from transformers import (
     is_tensorboard_available,
     set_seed,
 )
-from transformers.models.t5.modeling_flax_t5 import shift_tokens_right
 from transformers.utils import get_full_repo_name
 
 
 MODEL_CONFIG_CLASSES = list(FLAX_MODEL_FOR_MASKED_LM_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class TrainingArguments:
@@ -118,6 +161,12 @@ class TrainingArguments:
     num_train_epochs: float = field(
         default=3.0, metadata={"help": "Total number of training epochs to perform."}
     )
+    max_train_steps: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Total number of training steps to perform, required with `--streaming` where the size of the train split is unknown."
+        },
+    )
     warmup_steps: int = field(
         default=0, metadata={"help": "Linear warmup over warmup_steps."}
     )
@@ -149,6 +198,51 @@ class TrainingArguments:
     hub_token: str = field(
         default=None, metadata={"help": "The token to use to push to the Model Hub."}
     )
+    prefetch: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to collate upcoming training batches on background threads and transfer them to the devices"
+                " while the current step runs."
+            )
+        },
+    )
+    prefetch_depth: int = field(
+        default=2,
+        metadata={
+            "help": "Number of training batches prepared ahead of the current step when `--prefetch` is set."
+        },
+    )
+    prefetch_workers: int = field(
+        default=1,
+        metadata={
+            "help": "Number of threads collating training batches when `--prefetch` is set."
+        },
+    )
+    collator_workers: int = field(
+        default=0,
+        metadata={
+            "help": (
+                "Number of processes collating training batches into a shared-memory ring buffer. 0 collates in the"
+                " training process."
+            )
+        },
+    )
+    collator_ring_size: int = field(
+        default=4,
+        metadata={
+            "help": "Number of batches the collator processes can prepare ahead of the current step."
+        },
+    )
+    device_collation: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to run the span corruption of the training batches on the devices instead of the host, the"
+                " host then only gathers the raw token ids."
+            )
+        },
+    )
 
     def __post_init__(self):
         if self.output_dir is not None:
@@ -251,8 +345,20 @@ class DataTrainingArguments:
             "help": "The configuration name of the dataset to use (via the datasets library)."
         },
     )
+    dataset_revision: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "The version of the dataset to use (via the datasets library): a branch name, a tag or a commit id of"
+                " its hub repository. The latest version by default."
+            )
+        },
+    )
     train_file: Optional[str] = field(
-        default=None, metadata={"help": "The input training data file (a text file)."}
+        default=None,
+        metadata={
+            "help": "The input training data file (a text file), or a glob pattern of files like the shards of `ptlm dedup`."
+        },
     )
     validation_file: Optional[str] = field(
         default=None,
@@ -282,6 +388,15 @@ class DataTrainingArguments:
             "help": "The percentage of the train set used as validation set in case there's no validation split"
         },
     )
+    validation_split_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "The number of examples of the train set used as validation set in case there's no validation split,"
+                " takes precedence over `validation_split_percentage`."
+            )
+        },
+    )
     max_seq_length: Optional[int] = field(
         default=None,
         metadata={
@@ -305,12 +420,161 @@ class DataTrainingArguments:
         default=3.0,
         metadata={"help": "Mean span length of masked tokens"},
     )
+    span_mask_bank: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of a bank of pregenerated span masks the data collator samples from. The bank is"
+                " generated there if the directory does not exist yet."
+            )
+        },
+    )
+    span_mask_bank_size: int = field(
+        default=100000,
+        metadata={
+            "help": "Number of masks to generate when creating `span_mask_bank`."
+        },
+    )
+    token_store: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of a token store written by `ptlm token-store`. Training then reads the packed sequences"
+                " from it instead of loading and tokenizing the dataset."
+            )
+        },
+    )
+    overwrite_token_store: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether `ptlm token-store` may replace the directory at `--token_store` when it isn't a token"
+                " store. Existing token stores are always replaced."
+            )
+        },
+    )
+    token_store_mixture: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Comma-separated `path:weight` token stores written by `ptlm token-store`, e.g."
+                " `web:0.7,books:0.3`. Training batches mix the train splits of the stores at these weights, read in"
+                " place, and evaluation runs on the validation splits of all of them. Needs `--max_train_steps`."
+            )
+        },
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to stream the dataset instead of downloading and preprocessing it up front. The train"
+                " split is tokenized, packed and shuffled on the fly, the validation split is packed in memory."
+            )
+        },
+    )
+    shuffle_buffer_size: int = field(
+        default=10000,
+        metadata={
+            "help": "Number of packed sequences the train split is shuffled over with `--streaming`."
+        },
+    )
+    shuffle_block_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Number of consecutive packed sequences shuffled as a block. Blocks are shuffled, then sequences are"
+                " only shuffled within windows of `shuffle_window_blocks` blocks, so batches read a few contiguous"
+                " ranges of a memory-mapped token store instead of random rows. Sequences are fully shuffled by"
+                " default."
+            )
+        },
+    )
+    shuffle_window_blocks: int = field(
+        default=16,
+        metadata={
+            "help": "Number of blocks whose sequences are shuffled together with `--shuffle_block_size`."
+        },
+    )
+    max_eval_samples: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of packed validation sequences to evaluate on with `--streaming`, all of them by default."
+        },
+    )
+    premasked_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of span-corrupted examples written by `ptlm pre-mask`. Training then reads its batches"
+                " from there and skips the data collator."
+            )
+        },
+    )
+    overwrite_premasked_dir: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether `ptlm pre-mask` may replace the directory at `--premasked_dir` when it isn't a pre-masked"
+                " dataset. Existing pre-masked datasets are always replaced."
+            )
+        },
+    )
+    seq_length_buckets: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Comma-separated input lengths, e.g. `128,256,512`, replacing `max_seq_length`. Documents are cut into"
+                " sequences of these lengths instead of being packed across document boundaries, and training"
+                " interleaves batches of every length, compiling one train step per length."
+            )
+        },
+    )
+    max_bucket_drop_fraction: float = field(
+        default=0.1,
+        metadata={
+            "help": (
+                "Largest fraction of the tokens of a split that `--seq_length_buckets` may drop, the ends of documents"
+                " shorter than the shortest bucket and whole documents shorter than it. Bucketing fails beyond it."
+            )
+        },
+    )
+    segment_packing: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to record the document of every packed token, so that the encoder, the decoder and the"
+                " cross-attention only attend within a document and the decoder starts over at every document."
+            )
+        },
+    )
+    native_tokenization: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to tokenize with the batch encoder of the fast tokenizer, on its own thread pool, when writing"
+                " a token store or the preprocessing cache, instead of `datasets.map` with worker processes."
+            )
+        },
+    )
+    preprocessing_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory caching the packed sequences as token stores, keyed by a hash of the tokenizer, the"
+                " dataset, the sequence length and the packing settings. Runs with the same settings skip loading"
+                " and preprocessing the dataset."
+            )
+        },
+    )
 
     def __post_init__(self):
         if (
             self.dataset_name is None
             and self.train_file is None
             and self.validation_file is None
+            and self.token_store is None
+            and self.token_store_mixture is None
+            and self.premasked_dir is None
         ):
             raise ValueError(
                 "Need either a dataset name or a training/validation file."
@@ -332,6 +596,66 @@ class DataTrainingArguments:
                 ], "`validation_file` should be a csv, a json or a txt file."
 
 
+@dataclass
+class PremaskArguments:
+    """
+    Arguments of `ptlm pre-mask`.
+    """
+
+    premask_epochs: int = field(
+        default=1,
+        metadata={"help": "Number of epochs of the train split to span-corrupt."},
+    )
+    premask_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of processes corrupting the examples, all the cores by default."
+        },
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": "Random seed the noise masks are derived from."},
+    )
+
+
+@dataclass
+class ProfileArguments:
+    """
+    Arguments of `ptlm profile-corpus`.
+    """
+
+    profile_split: str = field(
+        default="train",
+        metadata={"help": "The split of the dataset to profile."},
+    )
+    candidate_seq_lengths: str = field(
+        default="128,256,512,1024",
+        metadata={"help": "Comma-separated `max_seq_length` values to report on."},
+    )
+    candidate_mean_noise_span_lengths: str = field(
+        default="3.0",
+        metadata={
+            "help": "Comma-separated `mean_noise_span_length` values to report on."
+        },
+    )
+    train_batch_size: int = field(
+        default=256,
+        metadata={
+            "help": "Global batch size, in sequences, the tokens per step are projected for."
+        },
+    )
+    max_documents: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of documents to profile from the start of the split, all of them by default."
+        },
+    )
+    profile_batch_size: int = field(
+        default=10000,
+        metadata={"help": "Number of texts tokenized at once."},
+    )
+
+
 def compute_input_and_target_lengths(
     inputs_length, noise_density, mean_noise_span_length
 ):
@@ -410,6 +734,11 @@ class FlaxDataCollatorForT5MLM:
             The pad token id of the model
         decoder_start_token_id: (:obj:`int):
             The decoder start token id of the model
+        mask_bank: (:class:`~t5mp.mask_bank.SpanMaskBank`, `optional`):
+            Pregenerated masks to sample from instead of drawing new ones for every batch
+
+    Sequences packed from several documents can be collated with their `segment_ids` (see `StreamingPacker`), the
+    batch then also holds the `encoder_segment_ids` and `decoder_segment_ids` of the inputs and labels.
     """
 
     tokenizer: PreTrainedTokenizerBase
@@ -419,52 +748,221 @@ class FlaxDataCollatorForT5MLM:
     target_length: int
     pad_token_id: int
     decoder_start_token_id: int
-
-    def __call__(self, examples: List[Dict[str, np.ndarray]]) -> BatchEncoding:
-
-        # convert list to dict and tensorize input
-        batch = BatchEncoding(
-            {
-                k: np.array([examples[i][k] for i in range(len(examples))])
-                for k, v in examples[0].items()
-            }
-        )
+    mask_bank: Optional[SpanMaskBank] = None
+
+    def __call__(
+        self,
+        examples: Union[np.ndarray, List[Dict[str, np.ndarray]]],
+        out: Optional[Dict[str, np.ndarray]] = None,
+        rng_key: Optional[np.ndarray] = None,
+        row_offset: int = 0,
+        segment_ids: Optional[np.ndarray] = None,
+    ) -> BatchEncoding:
+
+        if isinstance(examples, np.ndarray):
+            # already gathered `input_ids` of shape [batch_size, expanded_inputs_length], see `fetch_input_ids`
+            batch = BatchEncoding({"input_ids": examples})
+        else:
+            # convert list to dict and tensorize input
+            batch = BatchEncoding(
+                {
+                    k: np.array([examples[i][k] for i in range(len(examples))])
+                    for k, v in examples[0].items()
+                }
+            )
 
         input_ids = batch["input_ids"]
         batch_size, expandend_input_length = input_ids.shape
 
-        mask_indices = np.asarray(
-            [
-                self.random_spans_noise_mask(expandend_input_length)
-                for i in range(batch_size)
-            ]
+        if self.mask_bank is not None:
+            if rng_key is None:
+                bank_rows = np.random.randint(len(self.mask_bank), size=batch_size)
+            else:
+                bank_rows = self.random_sort_keys(
+                    batch_size, 1, rng_key=rng_key, row_offset=row_offset
+                )[:, 0] % np.uint64(len(self.mask_bank))
+            index_maps = self.mask_bank.take(bank_rows.astype(np.int64))
+            batch.update(
+                self.apply_index_maps(
+                    input_ids, index_maps, out=out, segment_ids=segment_ids
+                )
+            )
+            return batch
+
+        mask_indices = self.random_spans_noise_mask_batch(
+            batch_size, expandend_input_length, rng_key=rng_key, row_offset=row_offset
+        )
+
+        # to check that tokens are correctly preprocessed, one can run `self.tokenizer.batch_decode(input_ids)` and `self.tokenizer.batch_decode(labels)` here...
+        batch.update(
+            self.create_inputs_and_labels(
+                input_ids, mask_indices, out=out, segment_ids=segment_ids
+            )
         )
-        labels_mask = ~mask_indices
 
-        input_ids_sentinel = self.create_sentinel_ids(mask_indices.astype(np.int8))
-        labels_sentinel = self.create_sentinel_ids(labels_mask.astype(np.int8))
+        return batch
+
+    def create_inputs_and_labels(
+        self, input_ids, mask_indices, out=None, segment_ids=None
+    ):
+        """
+        Fused version of `create_sentinel_ids` and `filter_input_ids` for both the noise mask and its inverse.
+        Span starts and sentinel ids for the inputs and the labels are derived from a single cumulative sum over
+        `mask_indices`, and `input_ids`, `labels` and `decoder_input_ids` are gathered straight into their output
+        arrays. Pass `out` (a dict with arrays of shape `[batch_size, input_length]` for `input_ids` and
+        `[batch_size, target_length]` for `labels` and `decoder_input_ids`) to reuse the buffers across steps.
+        `segment_ids` of the tokens are gathered along, see `_add_segment_ids`.
+        """
+        batch_size = input_ids.shape[0]
+        if out is None:
+            out = self._empty_outputs(batch_size, input_ids.dtype)
 
-        batch["input_ids"] = self.filter_input_ids(input_ids, input_ids_sentinel)
-        batch["labels"] = self.filter_input_ids(input_ids, labels_sentinel)
+        span_starts, sentinel_ids = self._span_starts_and_sentinel_numbers(mask_indices)
+        np.subtract(len(self.tokenizer), sentinel_ids, out=sentinel_ids)
 
-        if batch["input_ids"].shape[-1] != self.input_length:
+        # inputs keep non-noise tokens and a sentinel at the start of each noise span, labels the other way round
+        keep = np.logical_or(span_starts, ~mask_indices)
+        inputs = np.where(mask_indices, sentinel_ids, input_ids)[keep]
+        if inputs.size != batch_size * (self.input_length - 1):
             raise ValueError(
-                f"`input_ids` are incorrectly preprocessed. `input_ids` length is {batch['input_ids'].shape[-1]}, but"
-                f" should be {self.target_length}."
+                f"`input_ids` are incorrectly preprocessed. `input_ids` length is {inputs.size // batch_size + 1}, but"
+                f" should be {self.input_length}."
             )
-
-        if batch["labels"].shape[-1] != self.target_length:
+        out["input_ids"][:, :-1] = inputs.reshape((batch_size, -1))
+        out["input_ids"][:, -1] = self.tokenizer.eos_token_id
+        if segment_ids is not None:
+            input_segment_ids = segment_ids[keep].reshape((batch_size, -1))
+
+        np.logical_or(span_starts, mask_indices, out=keep)
+        labels = np.where(mask_indices, input_ids, sentinel_ids)[keep]
+        if labels.size != batch_size * (self.target_length - 1):
             raise ValueError(
-                f"`labels` are incorrectly preprocessed. `labels` length is {batch['labels'].shape[-1]}, but should be"
+                f"`labels` are incorrectly preprocessed. `labels` length is {labels.size // batch_size + 1}, but should be"
                 f" {self.target_length}."
             )
+        out["labels"][:, :-1] = labels.reshape((batch_size, -1))
+        out["labels"][:, -1] = self.tokenizer.eos_token_id
+
+        # same as `shift_tokens_right`, labels never contain -100 here
+        out["decoder_input_ids"][:, 1:] = out["labels"][:, :-1]
+        out["decoder_input_ids"][:, 0] = self.decoder_start_token_id
+
+        if segment_ids is not None:
+            label_segment_ids = segment_ids[keep].reshape((batch_size, -1))
+            self._add_segment_ids(out, input_segment_ids, label_segment_ids)
+
+        return out
+
+    def _empty_outputs(self, batch_size, dtype):
+        return {
+            "input_ids": np.empty((batch_size, self.input_length), dtype=dtype),
+            "labels": np.empty((batch_size, self.target_length), dtype=dtype),
+            "decoder_input_ids": np.empty(
+                (batch_size, self.target_length), dtype=dtype
+            ),
+        }
 
-        # to check that tokens are correctly preprocessed, one can run `self.tokenizer.batch_decode(input_ids)` and `self.tokenizer.batch_decode(labels)` here...
-        batch["decoder_input_ids"] = shift_tokens_right(
-            batch["labels"], self.pad_token_id, self.decoder_start_token_id
+    def _add_segment_ids(self, out, input_segment_ids, label_segment_ids):
+        # the segment ids of the tokens the inputs and labels were taken from, EOS joins the segment before it.
+        # The decoder starts over at the first label of every segment, so that no segment is decoded from the labels
+        # of another one.
+        for key, values in (
+            ("encoder_segment_ids", input_segment_ids),
+            ("decoder_segment_ids", label_segment_ids),
+        ):
+            if key not in out:
+                out[key] = np.empty(
+                    (values.shape[0], values.shape[1] + 1), dtype=values.dtype
+                )
+            out[key][:, :-1] = values
+            out[key][:, -1] = values[:, -1]
+        segment_starts = (
+            out["decoder_segment_ids"][:, 1:] != out["decoder_segment_ids"][:, :-1]
+        )
+        out["decoder_input_ids"][:, 1:][segment_starts] = self.decoder_start_token_id
+        return out
+
+    @staticmethod
+    def _span_starts_and_sentinel_numbers(mask_indices):
+        # a span starts wherever the mask flips. Counting span starts numbers noise and non-noise spans
+        # alternately, so halving the count (rounded towards the span kind the row starts with) gives the
+        # sentinel number of noise spans in the inputs and of non-noise spans in the labels.
+        span_starts = np.empty_like(mask_indices)
+        span_starts[:, 0] = True
+        np.not_equal(mask_indices[:, 1:], mask_indices[:, :-1], out=span_starts[:, 1:])
+        sentinel_numbers = np.cumsum(span_starts, axis=-1, dtype=np.int32)
+        sentinel_numbers += mask_indices == mask_indices[:, :1]
+        sentinel_numbers >>= 1
+        return span_starts, sentinel_numbers
+
+    def create_index_maps(self, mask_indices):
+        """
+        Index maps describing how a noise mask turns a sequence into inputs and labels. For each position of the
+        inputs (labels), `input_positions` (`label_positions`) holds the position of the token it is taken from and
+        `input_sentinels` (`label_sentinels`) the number of the sentinel replacing it, or 0 to keep the token. The
+        maps do not depend on the tokens nor on the tokenizer, see `apply_index_maps`.
+        """
+        batch_size = mask_indices.shape[0]
+        span_starts, sentinel_numbers = self._span_starts_and_sentinel_numbers(
+            mask_indices
         )
 
-        return batch
+        # inputs keep non-noise tokens and a sentinel at the start of each noise span, labels the other way round
+        keep = np.logical_or(span_starts, ~mask_indices)
+        input_positions = np.nonzero(keep)[1]
+        if input_positions.size != batch_size * (self.input_length - 1):
+            raise ValueError(
+                f"`input_ids` are incorrectly preprocessed. `input_ids` length is"
+                f" {input_positions.size // batch_size + 1}, but should be {self.input_length}."
+            )
+        input_sentinels = np.where(mask_indices, sentinel_numbers, 0)[keep]
+
+        np.logical_or(span_starts, mask_indices, out=keep)
+        label_positions = np.nonzero(keep)[1]
+        if label_positions.size != batch_size * (self.target_length - 1):
+            raise ValueError(
+                f"`labels` are incorrectly preprocessed. `labels` length is"
+                f" {label_positions.size // batch_size + 1}, but should be {self.target_length}."
+            )
+        label_sentinels = np.where(mask_indices, 0, sentinel_numbers)[keep]
+
+        return {
+            "input_positions": input_positions.reshape((batch_size, -1)),
+            "input_sentinels": input_sentinels.reshape((batch_size, -1)),
+            "label_positions": label_positions.reshape((batch_size, -1)),
+            "label_sentinels": label_sentinels.reshape((batch_size, -1)),
+        }
+
+    def apply_index_maps(self, input_ids, index_maps, out=None, segment_ids=None):
+        """
+        Gathers `input_ids`, `labels` and `decoder_input_ids` from `input_ids` following `index_maps` (see
+        `create_index_maps`), writing into the arrays of `out` when given. `segment_ids` of the tokens are gathered
+        along, see `_add_segment_ids`.
+        """
+        if out is None:
+            out = self._empty_outputs(input_ids.shape[0], input_ids.dtype)
+
+        vocab_size = np.int32(len(self.tokenizer))
+        for key, prefix in (("input_ids", "input"), ("labels", "label")):
+            sentinels = index_maps[f"{prefix}_sentinels"]
+            tokens = np.take_along_axis(
+                input_ids, index_maps[f"{prefix}_positions"], axis=-1
+            )
+            out[key][:, :-1] = np.where(sentinels != 0, vocab_size - sentinels, tokens)
+            out[key][:, -1] = self.tokenizer.eos_token_id
+
+        # same as `shift_tokens_right`, labels never contain -100 here
+        out["decoder_input_ids"][:, 1:] = out["labels"][:, :-1]
+        out["decoder_input_ids"][:, 0] = self.decoder_start_token_id
+
+        if segment_ids is not None:
+            self._add_segment_ids(
+                out,
+                np.take_along_axis(segment_ids, index_maps["input_positions"], axis=-1),
+                np.take_along_axis(segment_ids, index_maps["label_positions"], axis=-1),
+            )
+
+        return out
 
     def create_sentinel_ids(self, mask_indices):
         """
@@ -572,38 +1070,965 @@ class FlaxDataCollatorForT5MLM:
 
         return is_noise[:orig_length]
 
+    def random_spans_noise_mask_batch(
+        self, batch_size, length, rng_key=None, row_offset=0
+    ):
+        """Batched version of :meth:`random_spans_noise_mask`.
 
-def generate_batch_splits(
-    samples_idx: np.ndarray, batch_size: int, drop_last=True
-) -> np.ndarray:
-    """Generate batches of data for a specified batch size from sample indices. If the dataset size is not divisible by
-    the batch size and `drop_last` is `True`, the last incomplete batch is dropped. Else, it is returned."""
-    num_samples = len(samples_idx)
-    if drop_last:
-        samples_to_remove = num_samples % batch_size
-        if samples_to_remove != 0:
-            samples_idx = samples_idx[:-samples_to_remove]
-        sections_split = num_samples // batch_size
-        samples_idx = samples_idx.reshape((sections_split, batch_size))
-    else:
-        sections_split = math.ceil(num_samples / batch_size)
-        samples_idx = np.array_split(samples_idx, sections_split)
-    return samples_idx
+        Draws `batch_size` independent noise masks at once. The number of noise tokens and spans is the
+        same for every row, so the random segmentations can be sampled for the whole batch with a single
+        argsort: the first `num_noise_spans - 1` entries of a random permutation of the `num_items - 1`
+        possible cut points form a uniformly random subset of them, which is exactly what shuffling the
+        boolean cut mask in `_random_segmentation` samples. Span lengths then come from the sorted cut
+        points instead of `np.unique`.
 
+        Args:
+            batch_size: an int - number of masks to generate
+            length: an int - length of the incoming token sequences
+            rng_key: an optional key from `noise_rng_key`, masks are drawn from the global numpy state without it
+            row_offset: an int - index of the first generated row in the global batch the key belongs to
 
-def write_train_metric(summary_writer, train_metrics, train_time, step):
-    summary_writer.scalar("train_time", train_time, step)
+        Returns:
+            a boolean array with shape [batch_size, length]
+        """
 
-    train_metrics = get_metrics(train_metrics)
-    for key, vals in train_metrics.items():
-        tag = f"train_{key}"
-        for i, val in enumerate(vals):
-            summary_writer.scalar(tag, val, step - len(vals) + i + 1)
+        num_noise_tokens = int(np.round(length * self.noise_density))
+        # avoid degeneracy by ensuring positive numbers of noise and nonnoise tokens.
+        num_noise_tokens = min(max(num_noise_tokens, 1), length - 1)
+        num_noise_spans = int(np.round(num_noise_tokens / self.mean_noise_span_length))
 
+        # avoid degeneracy by ensuring positive number of noise spans
+        num_noise_spans = max(num_noise_spans, 1)
+        num_nonnoise_tokens = length - num_noise_tokens
 
-def write_eval_metric(summary_writer, eval_metrics, step):
-    for metric_name, value in eval_metrics.items():
-        summary_writer.scalar(f"eval_{metric_name}", value, step)
+        # random sort keys for the cut points of both segmentations
+        sort_keys = self.random_sort_keys(
+            batch_size, length - 2, rng_key=rng_key, row_offset=row_offset
+        )
+
+        def _random_segmentation(num_items, num_segments, keys):
+            """Partition `batch_size` sequences of items randomly into non-empty segments.
+            Returns:
+                an array with shape [batch_size, num_segments] containing positive integers, each row
+                adding up to num_items
+            """
+            cut_points = np.argsort(keys, axis=-1)[:, : num_segments - 1]
+            cut_points.sort(axis=-1)
+            boundaries = np.empty((batch_size, num_segments + 1), dtype=np.int64)
+            boundaries[:, 0] = 0
+            boundaries[:, 1:-1] = cut_points + 1
+            boundaries[:, -1] = num_items
+            return np.diff(boundaries, axis=-1)
+
+        noise_span_lengths = _random_segmentation(
+            num_noise_tokens, num_noise_spans, sort_keys[:, : num_noise_tokens - 1]
+        )
+        nonnoise_span_lengths = _random_segmentation(
+            num_nonnoise_tokens, num_noise_spans, sort_keys[:, num_noise_tokens - 1 :]
+        )
+
+        interleaved_span_lengths = np.reshape(
+            np.stack([nonnoise_span_lengths, noise_span_lengths], axis=-1),
+            [batch_size, num_noise_spans * 2],
+        )
+        span_starts = np.cumsum(interleaved_span_lengths, axis=-1)[:, :-1]
+        span_start_indicator = np.zeros((batch_size, length), dtype=np.int8)
+        np.put_along_axis(span_start_indicator, span_starts, 1, axis=-1)
+        span_num = np.cumsum(span_start_indicator, axis=-1)
+        is_noise = np.equal(span_num % 2, 1)
+
+        return is_noise
+
+    @staticmethod
+    def random_sort_keys(batch_size, num_keys, rng_key=None, row_offset=0):
+        """
+        Random keys of shape `[batch_size, num_keys]`, only ever used through their ordering. Without `rng_key`
+        they are drawn from the global numpy state. With it, row `i` is drawn from a Philox counter range that only
+        depends on `rng_key` and `row_offset + i`, so any block of rows of a batch can be generated on its own, on
+        any worker or host, and comes out the same.
+        """
+        if rng_key is None:
+            return np.random.random_sample((batch_size, num_keys))
+        # Philox4x64 yields four 64-bit words per counter increment
+        counters_per_row = max(-(-num_keys // 4), 1)
+        bit_generator = np.random.Philox(
+            key=rng_key, counter=row_offset * counters_per_row
+        )
+        words = bit_generator.random_raw(batch_size * counters_per_row * 4)
+        return words.reshape((batch_size, -1))[:, :num_keys]
+
+
+@flax.struct.dataclass
+class FlaxDeviceDataCollatorForT5MLM:
+    """
+    Data collator for T5 span-masked language modeling running on the accelerators. It performs the same span
+    corruption as :class:`FlaxDataCollatorForT5MLM` as a pure function of a PRNG key and the raw
+    `[batch_size, expanded_inputs_length]` `input_ids`, so that it can be jitted or pmapped and fed straight from
+    the grouped dataset. All the output shapes are static: `input_length` and `target_length`.
+
+    Args:
+        vocab_size (:obj:`int`):
+            Length of the tokenizer, sentinels count down from it.
+        eos_token_id (:obj:`int`):
+            The end of sequence token id of the tokenizer.
+        noise_density (:obj:`float`):
+            The probability with which to (randomly) mask tokens in the input.
+        mean_noise_span_length (:obj:`float`):
+            The average span length of the masked tokens.
+        input_length (:obj:`int`):
+            The expected input length after masking.
+        target_length (:obj:`int`):
+            The expected target length after masking.
+        decoder_start_token_id: (:obj:`int):
+            The decoder start token id of the model
+    """
+
+    vocab_size: int
+    eos_token_id: int
+    noise_density: float
+    mean_noise_span_length: float
+    input_length: int
+    target_length: int
+    decoder_start_token_id: int
+
+    def __call__(self, rng, input_ids):
+        batch_size, expandend_input_length = input_ids.shape
+
+        mask_indices = self.random_spans_noise_mask_batch(
+            rng, batch_size, expandend_input_length
+        )
+
+        # see `FlaxDataCollatorForT5MLM.create_inputs_and_labels`
+        span_starts = jnp.concatenate(
+            [
+                jnp.ones((batch_size, 1), dtype=bool),
+                mask_indices[:, 1:] != mask_indices[:, :-1],
+            ],
+            axis=-1,
+        )
+        sentinel_numbers = (
+            jnp.cumsum(span_starts, axis=-1) + (mask_indices == mask_indices[:, :1])
+        ) >> 1
+        sentinel_ids = (self.vocab_size - sentinel_numbers).astype(input_ids.dtype)
+
+        input_ids, labels = (
+            self.compact(
+                span_starts | ~mask_indices,
+                jnp.where(mask_indices, sentinel_ids, input_ids),
+                self.input_length,
+            ),
+            self.compact(
+                span_starts | mask_indices,
+                jnp.where(mask_indices, input_ids, sentinel_ids),
+                self.target_length,
+            ),
+        )
+        decoder_input_ids = jnp.concatenate(
+            [
+                jnp.full((batch_size, 1), self.decoder_start_token_id, labels.dtype),
+                labels[:, :-1],
+            ],
+            axis=-1,
+        )
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "decoder_input_ids": decoder_input_ids,
+        }
+
+    def compact(self, keep, values, length):
+        """
+        Moves the `values` flagged by `keep` to the front of each row and appends EOS, giving rows of `length`.
+        Dropped values are scattered out of bounds, which keeps every shape static.
+        """
+        batch_size = values.shape[0]
+        positions = jnp.where(keep, jnp.cumsum(keep, axis=-1) - 1, length)
+        compacted = jnp.full((batch_size, length), self.eos_token_id, values.dtype)
+        compacted = compacted.at[jnp.arange(batch_size)[:, None], positions].set(
+            values, mode="drop"
+        )
+        return compacted.at[:, -1].set(self.eos_token_id)
+
+    def random_spans_noise_mask_batch(self, rng, batch_size, length):
+        """JAX version of :meth:`FlaxDataCollatorForT5MLM.random_spans_noise_mask_batch`."""
+
+        num_noise_tokens = int(np.round(length * self.noise_density))
+        # avoid degeneracy by ensuring positive numbers of noise and nonnoise tokens.
+        num_noise_tokens = min(max(num_noise_tokens, 1), length - 1)
+        num_noise_spans = int(np.round(num_noise_tokens / self.mean_noise_span_length))
+
+        # avoid degeneracy by ensuring positive number of noise spans
+        num_noise_spans = max(num_noise_spans, 1)
+        num_nonnoise_tokens = length - num_noise_tokens
+
+        sort_keys = jax.random.uniform(rng, (batch_size, length - 2))
+
+        def _random_segmentation(num_items, num_segments, keys):
+            cut_points = jnp.sort(
+                jnp.argsort(keys, axis=-1)[:, : num_segments - 1], axis=-1
+            )
+            boundaries = jnp.concatenate(
+                [
+                    jnp.zeros((batch_size, 1), dtype=cut_points.dtype),
+                    cut_points + 1,
+                    jnp.full((batch_size, 1), num_items, dtype=cut_points.dtype),
+                ],
+                axis=-1,
+            )
+            return jnp.diff(boundaries, axis=-1)
+
+        noise_span_lengths = _random_segmentation(
+            num_noise_tokens, num_noise_spans, sort_keys[:, : num_noise_tokens - 1]
+        )
+        nonnoise_span_lengths = _random_segmentation(
+            num_nonnoise_tokens, num_noise_spans, sort_keys[:, num_noise_tokens - 1 :]
+        )
+
+        interleaved_span_lengths = jnp.reshape(
+            jnp.stack([nonnoise_span_lengths, noise_span_lengths], axis=-1),
+            [batch_size, num_noise_spans * 2],
+        )
+        span_starts = jnp.cumsum(interleaved_span_lengths, axis=-1)[:, :-1]
+        span_start_indicator = (
+            jnp.zeros((batch_size, length), dtype=jnp.int32)
+            .at[jnp.arange(batch_size)[:, None], span_starts]
+            .set(1)
+        )
+        span_num = jnp.cumsum(span_start_indicator, axis=-1)
+
+        return span_num % 2 == 1
+
+
+def generate_batch_splits(
+    samples_idx: np.ndarray, batch_size: int, drop_last=True
+) -> np.ndarray:
+    """Generate batches of data for a specified batch size from sample indices. If the dataset size is not divisible by
+    the batch size and `drop_last` is `True`, the last incomplete batch is dropped. Else, it is returned."""
+    num_samples = len(samples_idx)
+    if drop_last:
+        samples_to_remove = num_samples % batch_size
+        if samples_to_remove != 0:
+            samples_idx = samples_idx[:-samples_to_remove]
+        sections_split = num_samples // batch_size
+        samples_idx = samples_idx.reshape((sections_split, batch_size))
+    else:
+        sections_split = math.ceil(num_samples / batch_size)
+        samples_idx = np.array_split(samples_idx, sections_split)
+    return samples_idx
+
+
+def write_train_metric(summary_writer, train_metrics, train_time, step):
+    summary_writer.scalar("train_time", train_time, step)
+
+    train_metrics = get_metrics(train_metrics)
+    for key, vals in train_metrics.items():
+        tag = f"train_{key}"
+        for i, val in enumerate(vals):
+            summary_writer.scalar(tag, val, step - len(vals) + i + 1)
+
+
+def write_eval_metric(summary_writer, eval_metrics, step):
+    for metric_name, value in eval_metrics.items():
+        summary_writer.scalar(f"eval_{metric_name}", value, step)
+
+
+def load_raw_datasets(model_args, data_args) -> DatasetDict:
+    """Loads the train and validation splits of the dataset or files named by `data_args`."""
+    # Get the datasets: you can either provide your own CSV/JSON/TXT training and evaluation files (see below)
+    # or just provide the name of one of the public datasets available on the hub at https://huggingface.co/datasets/
+    # (the dataset will be downloaded automatically from the datasets Hub).
+    #
+    # For CSV/JSON files, this script will use the column called 'text' or the first column if no column called
+    # 'text' is found. You can easily tweak this behavior (see below).
+    if data_args.dataset_name is not None:
+        # Downloading and loading a dataset from the hub.
+        datasets = load_dataset(
+            data_args.dataset_name,
+            data_args.dataset_config_name,
+            revision=data_args.dataset_revision,
+            cache_dir=model_args.cache_dir,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+
+    else:
+        data_files = {}
+        if data_args.train_file is not None:
+            data_files["train"] = data_args.train_file
+        if data_args.validation_file is not None:
+            data_files["validation"] = data_args.validation_file
+        extension = data_args.train_file.split(".")[-1]
+        if extension == "txt":
+            extension = "text"
+        datasets = load_dataset(
+            extension,
+            data_files=data_files,
+            cache_dir=model_args.cache_dir,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+
+    # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
+    # https://huggingface.co/docs/datasets/loading_datasets.html.
+
+    if "validation" not in datasets.keys():
+        # hold out the head of the train split. `select` only builds an indices mapping over the loaded table
+        # (datasets 2.4, later versions slice contiguous ranges), so the files are not read or hashed again
+        train_dataset = datasets["train"]
+        if data_args.validation_split_size is not None:
+            num_validation = min(data_args.validation_split_size, len(train_dataset))
+        else:
+            # rounded like the `train[:N%]` split instructions of `load_dataset`
+            num_validation = int(
+                round(data_args.validation_split_percentage * len(train_dataset) / 100)
+            )
+        datasets["validation"] = train_dataset.select(range(num_validation))
+        datasets["train"] = train_dataset.select(
+            range(num_validation, len(train_dataset))
+        )
+
+    return datasets
+
+
+def load_streaming_datasets(model_args, data_args):
+    """Opens the splits of the dataset or files named by `data_args` as iterable datasets read on the fly."""
+    if data_args.dataset_name is not None:
+        return load_dataset(
+            data_args.dataset_name,
+            data_args.dataset_config_name,
+            revision=data_args.dataset_revision,
+            cache_dir=model_args.cache_dir,
+            use_auth_token=True if model_args.use_auth_token else None,
+            streaming=True,
+        )
+
+    data_files = {}
+    if data_args.train_file is not None:
+        data_files["train"] = data_args.train_file
+    if data_args.validation_file is not None:
+        data_files["validation"] = data_args.validation_file
+    extension = data_args.train_file.split(".")[-1]
+    if extension == "txt":
+        extension = "text"
+    return load_dataset(
+        extension,
+        data_files=data_files,
+        cache_dir=model_args.cache_dir,
+        use_auth_token=True if model_args.use_auth_token else None,
+        streaming=True,
+    )
+
+
+def load_host_train_stream(model_args, data_args, train_stream, host, num_hosts):
+    """
+    The share of the streamed train split `train_stream` that `host` of `num_hosts` reads on its own, so that hosts
+    don't all read and parse the whole stream. Hosts take disjoint train files when `--train_file` matches at least
+    one per host, or disjoint shards of the dataset with `split_dataset_by_node` when the shards split evenly. None
+    when the stream can't be split, every host then has to read all of it and keep its share of the documents.
+    """
+    if num_hosts == 1:
+        return train_stream
+    if data_args.train_file is not None:
+        files = sorted(glob.glob(data_args.train_file))
+        if len(files) >= num_hosts:
+            extension = data_args.train_file.split(".")[-1]
+            if extension == "txt":
+                extension = "text"
+            return load_dataset(
+                extension,
+                data_files={"train": files[host::num_hosts]},
+                split="train",
+                cache_dir=model_args.cache_dir,
+                use_auth_token=True if model_args.use_auth_token else None,
+                streaming=True,
+            )
+    num_shards = getattr(train_stream, "n_shards", 0)
+    if (
+        split_dataset_by_node is not None
+        and num_shards > 0
+        and num_shards % num_hosts == 0
+    ):
+        return split_dataset_by_node(train_stream, rank=host, world_size=num_hosts)
+    logger.warning(
+        f"The train stream can't be split between {num_hosts} hosts, every host reads all of it and keeps one"
+        f" document out of {num_hosts}. Pass at least one train file per host to `--train_file` to avoid this."
+    )
+    return None
+
+
+def example_texts(examples):
+    """Texts of the column called 'text' of `examples`, or of their first column if there is none."""
+    for example in examples:
+        yield example["text"] if "text" in example else next(iter(example.values()))
+
+
+def load_tokenizer(model_args) -> PreTrainedTokenizerBase:
+    if model_args.tokenizer_name:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.tokenizer_name,
+            cache_dir=model_args.cache_dir,
+            use_fast=model_args.use_fast_tokenizer,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+    elif model_args.model_name_or_path:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.model_name_or_path,
+            cache_dir=model_args.cache_dir,
+            use_fast=model_args.use_fast_tokenizer,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+    else:
+        raise ValueError(
+            "You are instantiating a new tokenizer from scratch. This is not supported by this script."
+            "You can do it from another script, save it, and load it from here, using --tokenizer_name."
+        )
+    return tokenizer
+
+
+def text_columns(datasets):
+    """The column names of `datasets` and the name of the column holding the texts."""
+    if "train" in datasets:
+        column_names = datasets["train"].column_names
+    else:
+        column_names = datasets["validation"].column_names
+    text_column_name = "text" if "text" in column_names else column_names[0]
+    return column_names, text_column_name
+
+
+def tokenize_datasets(datasets, tokenizer, data_args) -> DatasetDict:
+    """Tokenizes the texts of `datasets`, one row of token ids per document."""
+    # Preprocessing the datasets.
+    # First we tokenize all the texts.
+    column_names, text_column_name = text_columns(datasets)
+
+    # Otherwise, we tokenize every text, then concatenate them together before splitting them in smaller parts.
+    # Since we make sure that all sequences are of the same length, no attention_mask is needed.
+    def tokenize_function(examples):
+        return tokenizer(examples[text_column_name], return_attention_mask=False)
+
+    return datasets.map(
+        tokenize_function,
+        batched=True,
+        num_proc=data_args.preprocessing_num_workers,
+        remove_columns=column_names,
+        load_from_cache_file=not data_args.overwrite_cache,
+    )
+
+
+def tokenize_and_pack(
+    datasets, tokenizer, data_args, expanded_inputs_length, segment_ids=False
+) -> DatasetDict:
+    """
+    Tokenizes the texts of `datasets` and packs them into sequences of `expanded_inputs_length` tokens, along with
+    the segment ids of their tokens with `segment_ids`.
+    """
+    tokenized_datasets = tokenize_datasets(datasets, tokenizer, data_args)
+
+    # Main data processing function that will concatenate all texts from our dataset and generate chunks of
+    # expanded_inputs_length. The batches are handed over as Arrow tables and packed as flat token arrays by a
+    # `StreamingPacker`, which carries the tokens left at the end of a batch over to the next one, so only the tail
+    # of each split (of each worker's shard with multiprocessing) is thrown away. Every split gets its own packer
+    # so that no tokens leak from one split into another.
+    #
+    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
+    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
+    packed_datasets = {}
+    for split, dataset in tokenized_datasets.items():
+        packed_datasets[split] = (
+            dataset.with_format("arrow")
+            .map(
+                StreamingPacker(expanded_inputs_length, segment_ids=segment_ids),
+                batched=True,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=not data_args.overwrite_cache,
+            )
+            .with_format(None)
+        )
+        num_tokens = count_tokens(dataset.data.column("input_ids"))
+        tokens_kept = len(packed_datasets[split]) * expanded_inputs_length
+        logger.info(
+            f"Packed {split} split into {len(packed_datasets[split])} sequences of {expanded_inputs_length} tokens: "
+            f"{tokens_kept} tokens kept, {num_tokens - tokens_kept} of {num_tokens} dropped "
+            f"({(num_tokens - tokens_kept) / max(num_tokens, 1):.4%})"
+        )
+    return DatasetDict(packed_datasets)
+
+
+def tokenize_and_bucket(datasets, tokenizer, data_args, expanded_lengths):
+    """
+    Tokenizes the texts of `datasets` and cuts every document into sequences of the bucket lengths, longest first
+    (see `DocumentChunker`), so that no sequence spans two documents. `expanded_lengths` maps the input length of
+    every bucket to its expanded inputs length. Returns the datasets of every bucket by input length. Raises when more
+    than `--max_bucket_drop_fraction` of the tokens of a split don't fit a bucket.
+    """
+    tokenized_datasets = tokenize_datasets(datasets, tokenizer, data_args)
+    lengths = list(expanded_lengths.values())
+    for split, dataset in tokenized_datasets.items():
+        document_lengths = list_column_lengths(dataset.data.column("input_ids"))
+        dropped_tokens = bucket_dropped_tokens(document_lengths, lengths)
+        num_tokens = int(document_lengths.sum())
+        dropped_fraction = int(dropped_tokens.sum()) / max(num_tokens, 1)
+        short_documents = (document_lengths > 0) & (dropped_tokens == document_lengths)
+        logger.info(
+            f"Bucketing {split} split: {int(dropped_tokens.sum())} of {num_tokens} tokens dropped "
+            f"({dropped_fraction:.4%}), {np.count_nonzero(short_documents)} of {len(document_lengths)} documents "
+            f"({int(document_lengths[short_documents].sum())} tokens) dropped whole for being shorter than the "
+            f"shortest bucket of {min(lengths)} tokens"
+        )
+        if dropped_fraction > data_args.max_bucket_drop_fraction:
+            raise ValueError(
+                f"`--seq_length_buckets` drops {dropped_fraction:.2%} of the tokens of the {split} split, more than"
+                f" `--max_bucket_drop_fraction` ({data_args.max_bucket_drop_fraction:.2%}). Add a shorter bucket,"
+                " or pack documents together with `--max_seq_length` and `--segment_packing` instead."
+            )
+    bucket_datasets = {}
+    for bucket, input_length in enumerate(expanded_lengths):
+        bucket_datasets[input_length] = (
+            tokenized_datasets.with_format("arrow")
+            .map(
+                DocumentChunker(lengths, bucket),
+                batched=True,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=not data_args.overwrite_cache,
+            )
+            .with_format(None)
+        )
+        logger.info(
+            f"Bucket of {input_length} tokens ({lengths[bucket]} before span corruption): "
+            + ", ".join(
+                f"{len(dataset)} {split} sequences"
+                for split, dataset in bucket_datasets[input_length].items()
+            )
+        )
+    return bucket_datasets
+
+
+def encode_and_pack(datasets, tokenizer, expanded_inputs_length, batch_size=10000):
+    """
+    Tokenizes the texts of `datasets` with the Rust tokenizer behind `tokenizer`, `batch_size` texts at a time on its
+    native thread pool, and packs them into sequences of `expanded_inputs_length` tokens. Nothing goes through
+    `datasets.map`: no worker processes, no intermediate Arrow cache. Returns, for every split, an iterable of the
+    packed sequences as `[num_sequences, expanded_inputs_length]` arrays, see `TokenStore.write_sequences`.
+    """
+    _, text_column_name = text_columns(datasets)
+    backend_tokenizer = native_tokenizer(tokenizer)
+
+    def packed_split(split, dataset):
+        texts = dataset.with_format("arrow")
+        packer = StreamingPacker(expanded_inputs_length)
+        for start in range(0, len(dataset), batch_size):
+            batch = texts[start : start + batch_size].column(text_column_name)
+            input_ids = encode_texts(backend_tokenizer, batch.to_pylist())
+            yield packer.pack({"input_ids": input_ids})["input_ids"]
+        logger.info(
+            f"Packed {split} split into {packer.tokens_packed // expanded_inputs_length} sequences of"
+            f" {expanded_inputs_length} tokens: {packer.tokens_packed} tokens kept,"
+            f" {packer.tokens_seen - packer.tokens_packed} of {packer.tokens_seen} dropped"
+        )
+
+    return {split: packed_split(split, dataset) for split, dataset in datasets.items()}
+
+
+def write_packed_token_store(
+    path,
+    model_args,
+    data_args,
+    tokenizer,
+    expanded_inputs_length,
+    overwrite=False,
+    **params,
+):
+    """
+    Loads, tokenizes and packs the dataset into sequences of `expanded_inputs_length` tokens and writes them to a
+    token store at `path`, see `TokenStore.write`. With `--native_tokenization`, the texts are encoded straight into
+    the store by `encode_and_pack` instead of going through `datasets.map`.
+    """
+    datasets = load_raw_datasets(model_args, data_args)
+    params = dict(tokenizer=tokenizer.name_or_path, **params)
+    if data_args.native_tokenization:
+        return TokenStore.write_sequences(
+            path,
+            encode_and_pack(datasets, tokenizer, expanded_inputs_length),
+            expanded_inputs_length,
+            len(tokenizer),
+            overwrite=overwrite,
+            **params,
+        )
+    return TokenStore.write(
+        path,
+        tokenize_and_pack(datasets, tokenizer, data_args, expanded_inputs_length),
+        expanded_inputs_length,
+        len(tokenizer),
+        overwrite=overwrite,
+        **params,
+    )
+
+
+def load_config(model_args, tokenizer) -> T5Config:
+    if model_args.config_name:
+        config = T5Config.from_pretrained(
+            model_args.config_name,
+            cache_dir=model_args.cache_dir,
+            vocab_size=len(tokenizer),
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+    elif model_args.model_name_or_path:
+        config = T5Config.from_pretrained(
+            model_args.model_name_or_path,
+            cache_dir=model_args.cache_dir,
+            use_auth_token=True if model_args.use_auth_token else None,
+        )
+    else:
+        config = CONFIG_MAPPING[model_args.model_type]()
+        logger.warning("You are instantiating a new config instance from scratch.")
+    return config
+
+
+def load_packed_datasets(model_args, data_args, tokenizer, expanded_inputs_length):
+    """
+    Packed sequences of `expanded_inputs_length` tokens of the dataset, read from `--token_store`, from
+    `--preprocessing_cache_dir` or tokenized and packed from scratch.
+    """
+    if data_args.token_store is not None:
+        tokenized_datasets = TokenStore.load_splits(data_args.token_store)
+        check_token_store(tokenized_datasets, tokenizer, expanded_inputs_length)
+        return tokenized_datasets
+    if data_args.preprocessing_cache_dir is not None:
+        return load_cached_token_store(
+            model_args, data_args, tokenizer, expanded_inputs_length
+        )
+    return tokenize_and_pack(
+        load_raw_datasets(model_args, data_args),
+        tokenizer,
+        data_args,
+        expanded_inputs_length,
+        segment_ids=data_args.segment_packing,
+    )
+
+
+def load_token_store_mixture(data_args, tokenizer, expanded_inputs_length):
+    """The splits of every token store of `--token_store_mixture` and the weight of every store."""
+    mixture_datasets, weights = [], []
+    for source in data_args.token_store_mixture.split(","):
+        path, _, weight = source.rpartition(":")
+        if not path:
+            raise ValueError(
+                f"Token store mixture sources are `path:weight`, got `{source}`."
+            )
+        token_store = TokenStore.load_splits(path)
+        check_token_store(token_store, tokenizer, expanded_inputs_length)
+        if "train" not in token_store:
+            raise ValueError(f"Token store {path} has no train split.")
+        mixture_datasets.append(token_store)
+        weights.append(float(weight))
+    # training evaluates on the non-empty validation splits of the stores every `eval_steps`
+    if not any(
+        len(token_store.get("validation", ())) for token_store in mixture_datasets
+    ):
+        raise ValueError(
+            "None of the token stores of `--token_store_mixture` has a validation split to evaluate on."
+        )
+    return mixture_datasets, weights
+
+
+def check_token_store(token_store, tokenizer, expanded_inputs_length):
+    """Raises if the splits of `token_store` were not packed for `expanded_inputs_length` with `tokenizer`."""
+    index = next(iter(token_store.values())).index
+    if index["sequence_length"] != expanded_inputs_length:
+        raise ValueError(
+            f"The token store holds sequences of {index['sequence_length']} tokens but {expanded_inputs_length} are"
+            " needed for the requested `max_seq_length`, `mlm_probability` and `mean_noise_span_length`."
+        )
+    if index["vocab_size"] != len(tokenizer):
+        raise ValueError(
+            f"The token store was written with a vocabulary of {index['vocab_size']} tokens but the tokenizer has"
+            f" {len(tokenizer)}."
+        )
+
+
+# Bumped whenever tokenization or packing changes the sequences written for the same settings, or the settings the
+# key is computed from change.
+PREPROCESSING_CACHE_VERSION = 2
+
+
+def preprocessing_cache_key(data_args, tokenizer, expanded_inputs_length) -> str:
+    """
+    Hash of everything the packed sequences depend on: the full tokenizer definition (tokenizer.json for fast
+    tokenizers), the dataset name and revision or the paths, sizes and modification times of the data files, the
+    validation split, `expanded_inputs_length` and the packing settings. `max_seq_length`, `mlm_probability` and
+    `mean_noise_span_length` only matter through `expanded_inputs_length`.
+    """
+    if tokenizer.is_fast:
+        tokenizer_definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        tokenizer_definition = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+
+    data_files = {}
+    for name in ("train_file", "validation_file"):
+        path = getattr(data_args, name)
+        if path is not None:
+            # `path` can be a glob pattern of several files, e.g. the shards of `ptlm dedup`
+            if not glob.glob(path):
+                raise ValueError(f"No data files match `--{name}` {path}.")
+            data_files[name] = [
+                [os.path.abspath(file), stat.st_size, stat.st_mtime_ns]
+                for file, stat in (
+                    (file, os.stat(file)) for file in sorted(glob.glob(path))
+                )
+            ]
+
+    settings = {
+        "version": PREPROCESSING_CACHE_VERSION,
+        "tokenizer": hashlib.sha256(tokenizer_definition.encode()).hexdigest(),
+        "dataset_name": data_args.dataset_name,
+        "dataset_config_name": data_args.dataset_config_name,
+        # without a revision the latest version is loaded, which may change upstream under the same key
+        "dataset_revision": data_args.dataset_revision,
+        "data_files": data_files,
+        "validation_split_percentage": data_args.validation_split_percentage,
+        "validation_split_size": data_args.validation_split_size,
+        "expanded_inputs_length": expanded_inputs_length,
+        # every worker shard drops its own packing remainder
+        "preprocessing_num_workers": data_args.preprocessing_num_workers,
+        "native_tokenization": data_args.native_tokenization,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_token_store(model_args, data_args, tokenizer, expanded_inputs_length):
+    """
+    Packed sequences of the dataset from the preprocessing cache. On a cache miss, or with `--overwrite_cache`, the
+    first host loads, tokenizes and packs the dataset and writes it to the cache as a token store, the other hosts
+    wait for it.
+    """
+    key = preprocessing_cache_key(data_args, tokenizer, expanded_inputs_length)
+    path = os.path.join(data_args.preprocessing_cache_dir, key)
+
+    def write_cache():
+        logger.info(f"Preprocessing the dataset into {path}")
+        write_packed_token_store(
+            path,
+            model_args,
+            data_args,
+            tokenizer,
+            expanded_inputs_length,
+            cache_key=key,
+        )
+
+    # only the first host writes the cache, hosts sharing a filesystem would race on the same temporary directory
+    if jax.process_index() == 0 and (
+        data_args.overwrite_cache or not os.path.exists(path)
+    ):
+        write_cache()
+    multihost_utils.sync_global_devices("token_store_cache")
+    # the cache only depends on its key, hosts that don't see the first host's cache write the same one
+    if not os.path.exists(path):
+        write_cache()
+    logger.info(f"Loading preprocessed sequences from {path}")
+    return TokenStore.load_splits(path)
+
+
+@click.command(
+    "token-store",
+    context_settings=dict(ignore_unknown_options=True, allow_extra_args=True),
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def write_token_store(args):
+    """
+    Tokenizes and packs the dataset the same way as `train-model` and writes it to the token store at
+    `--token_store`, to be passed to `train-model` with the same `--token_store`.
+    """
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments))
+    model_args, data_args = parser.parse_args_into_dataclasses(args=args)
+    if data_args.token_store is None:
+        raise ValueError("`--token_store` is required to write a token store.")
+    if data_args.dataset_name is None and data_args.train_file is None:
+        raise ValueError("Need either a dataset name or a training file.")
+    # fail before preprocessing the dataset rather than after
+    check_replaceable(
+        data_args.token_store,
+        "index.json",
+        "--overwrite_token_store",
+        data_args.overwrite_token_store,
+    )
+
+    tokenizer = load_tokenizer(model_args)
+    max_seq_length = min(data_args.max_seq_length, tokenizer.model_max_length)
+    expanded_inputs_length, _ = compute_input_and_target_lengths(
+        inputs_length=max_seq_length,
+        noise_density=data_args.mlm_probability,
+        mean_noise_span_length=data_args.mean_noise_span_length,
+    )
+
+    logger.info(f"Writing token store to {data_args.token_store}")
+    write_packed_token_store(
+        data_args.token_store,
+        model_args,
+        data_args,
+        tokenizer,
+        expanded_inputs_length,
+        overwrite=data_args.overwrite_token_store,
+        max_seq_length=max_seq_length,
+        mlm_probability=data_args.mlm_probability,
+        mean_noise_span_length=data_args.mean_noise_span_length,
+    )
+
+
+@click.command(
+    "pre-mask",
+    context_settings=dict(ignore_unknown_options=True, allow_extra_args=True),
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def pre_mask(args):
+    """
+    Span-corrupts `--premask_epochs` epochs of the packed train split, and the validation split once, on all the
+    cores and writes them to `--premasked_dir`, to be passed to `train-model` with the same `--premasked_dir`.
+    """
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, PremaskArguments))
+    model_args, data_args, premask_args = parser.parse_args_into_dataclasses(args=args)
+    if data_args.premasked_dir is None:
+        raise ValueError("`--premasked_dir` is required to pre-mask a dataset.")
+    if (
+        data_args.token_store is None
+        and data_args.dataset_name is None
+        and data_args.train_file is None
+    ):
+        raise ValueError(
+            "Need either a token store, a dataset name or a training file."
+        )
+    # fail before preprocessing the dataset rather than after
+    check_replaceable(
+        data_args.premasked_dir,
+        "premask.json",
+        "--overwrite_premasked_dir",
+        data_args.overwrite_premasked_dir,
+    )
+
+    tokenizer = load_tokenizer(model_args)
+    config = load_config(model_args, tokenizer)
+    max_seq_length = min(data_args.max_seq_length, tokenizer.model_max_length)
+    expanded_inputs_length, targets_length = compute_input_and_target_lengths(
+        inputs_length=max_seq_length,
+        noise_density=data_args.mlm_probability,
+        mean_noise_span_length=data_args.mean_noise_span_length,
+    )
+    tokenized_datasets = load_packed_datasets(
+        model_args, data_args, tokenizer, expanded_inputs_length
+    )
+    data_collator = FlaxDataCollatorForT5MLM(
+        tokenizer=tokenizer,
+        noise_density=data_args.mlm_probability,
+        mean_noise_span_length=data_args.mean_noise_span_length,
+        input_length=max_seq_length,
+        target_length=targets_length,
+        pad_token_id=config.pad_token_id,
+        decoder_start_token_id=config.decoder_start_token_id,
+    )
+
+    logger.info(
+        f"Writing {premask_args.premask_epochs} pre-masked epochs to {data_args.premasked_dir}"
+    )
+    PremaskedDataset.write(
+        data_args.premasked_dir,
+        tokenized_datasets,
+        data_collator,
+        num_epochs={
+            split: premask_args.premask_epochs if split == "train" else 1
+            for split in tokenized_datasets
+        },
+        seed=premask_args.seed,
+        num_workers=premask_args.premask_workers,
+        overwrite=data_args.overwrite_premasked_dir,
+    )
+
+
+@click.command(
+    "profile-corpus",
+    context_settings=dict(ignore_unknown_options=True, allow_extra_args=True),
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def profile_corpus(args):
+    """
+    Streams a split of the dataset through the batch encoder of the tokenizer, on its native thread pool, and reports
+    the document length histogram and, for every candidate `max_seq_length` and `mean_noise_span_length`, the
+    expanded inputs and targets lengths, the tokens dropped by packing and by cutting documents on their own, and
+    the tokens per training step. Nothing is downloaded up front nor written to disk.
+    """
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, ProfileArguments))
+    model_args, data_args, profile_args = parser.parse_args_into_dataclasses(args=args)
+    if data_args.dataset_name is None and data_args.train_file is None:
+        raise ValueError("Need either a dataset name or a training file.")
+
+    tokenizer = load_tokenizer(model_args)
+    backend_tokenizer = native_tokenizer(tokenizer)
+    datasets = load_streaming_datasets(model_args, data_args)
+    if profile_args.profile_split not in datasets:
+        raise ValueError(
+            f"The dataset has no {profile_args.profile_split} split, available splits: {list(datasets)}."
+        )
+
+    texts = islice(
+        example_texts(datasets[profile_args.profile_split]),
+        profile_args.max_documents,
+    )
+    profile = LengthProfile()
+    batches = iter(lambda: list(islice(texts, profile_args.profile_batch_size)), [])
+    for batch in tqdm(batches, desc="Profiling ...", unit="batch"):
+        profile.update(encode_lengths(backend_tokenizer, batch))
+    if profile.num_documents == 0:
+        raise ValueError(f"The {profile_args.profile_split} split is empty.")
+
+    click.echo(
+        f"{profile.num_documents} documents, {profile.num_tokens} tokens,"
+        f" {profile.num_tokens / profile.num_documents:.1f} tokens per document on average,"
+        f" p50 {profile.percentile(50)}, p90 {profile.percentile(90)}, p99 {profile.percentile(99)},"
+        f" max {len(profile.counts) - 1}"
+    )
+    click.echo(
+        f"\n{'tokens':>20} {'documents':>12} {'% docs':>8} {'cum %':>8} {'% tokens':>9}"
+    )
+    cumulative_documents = 0
+    for low, high, num_documents, num_tokens in profile.histogram():
+        cumulative_documents += num_documents
+        click.echo(
+            f"{f'[{low}, {high})':>20} {num_documents:>12} {num_documents / profile.num_documents:>8.2%}"
+            f" {cumulative_documents / profile.num_documents:>8.2%} {num_tokens / max(profile.num_tokens, 1):>9.2%}"
+        )
+
+    # every preprocessing worker packs its own shard and drops its own remainder, see `tokenize_and_pack`
+    num_streams = data_args.preprocessing_num_workers or 1
+    batch_size = profile_args.train_batch_size
+    click.echo(
+        f"\n{'input':>6} {'span':>5} {'expanded':>9} {'targets':>8} {'sequences':>11} {'packing drop':>13}"
+        f" {'chunking drop':>14} {'padding eff':>12} {'corpus tok/step':>16} {'model tok/step':>15}"
+        f" {'steps/epoch':>12}"
+    )
+    for input_length in [
+        int(length) for length in profile_args.candidate_seq_lengths.split(",")
+    ]:
+        for mean_noise_span_length in [
+            float(length)
+            for length in profile_args.candidate_mean_noise_span_lengths.split(",")
+        ]:
+            expanded_inputs_length, targets_length = compute_input_and_target_lengths(
+                inputs_length=input_length,
+                noise_density=data_args.mlm_probability,
+                mean_noise_span_length=mean_noise_span_length,
+            )
+            packing_dropped = profile.packing_dropped_tokens(
+                expanded_inputs_length, num_streams
+            )
+            num_sequences = (
+                profile.num_tokens - packing_dropped
+            ) // expanded_inputs_length
+            chunking_dropped = profile.chunking_dropped_tokens(expanded_inputs_length)
+            click.echo(
+                f"{input_length:>6} {mean_noise_span_length:>5} {expanded_inputs_length:>9} {targets_length:>8}"
+                f" {num_sequences:>11} {packing_dropped / profile.num_tokens:>13.4%}"
+                f" {chunking_dropped / profile.num_tokens:>14.2%}"
+                f" {profile.padding_efficiency(expanded_inputs_length):>12.2%}"
+                f" {batch_size * expanded_inputs_length:>16} {batch_size * (input_length + targets_length):>15}"
+                f" {num_sequences // batch_size:>12}"
+            )
 
 
 @click.command(
@@ -640,6 +2065,94 @@ def train_model(args):
             "Use --overwrite_output_dir to overcome."
         )
 
+    if training_args.device_collation and (
+        training_args.collator_workers > 0 or data_args.span_mask_bank is not None
+    ):
+        raise ValueError(
+            "`--device_collation` can't be combined with `--collator_workers` or `--span_mask_bank`, those only"
+            " apply to the host data collator."
+        )
+
+    if data_args.streaming and training_args.max_train_steps is None:
+        raise ValueError(
+            "`--streaming` requires `--max_train_steps`, the number of steps can't be derived from a stream."
+        )
+    if data_args.streaming and (
+        training_args.collator_workers > 0
+        or data_args.token_store is not None
+        or data_args.preprocessing_cache_dir is not None
+    ):
+        raise ValueError(
+            "`--streaming` can't be combined with `--collator_workers`, `--token_store` or"
+            " `--preprocessing_cache_dir`, those read a preprocessed train split."
+        )
+
+    if data_args.token_store_mixture is not None and (
+        training_args.max_train_steps is None
+        or data_args.streaming
+        or data_args.token_store is not None
+        or data_args.preprocessing_cache_dir is not None
+        or data_args.premasked_dir is not None
+        or data_args.seq_length_buckets is not None
+        or data_args.segment_packing
+        or data_args.shuffle_block_size is not None
+        or training_args.collator_workers > 0
+    ):
+        raise ValueError(
+            "`--token_store_mixture` requires `--max_train_steps` and can't be combined with `--streaming`,"
+            " `--token_store`, `--preprocessing_cache_dir`, `--premasked_dir`, `--seq_length_buckets`,"
+            " `--segment_packing`, `--shuffle_block_size` or `--collator_workers`."
+        )
+
+    if data_args.shuffle_block_size is not None and (
+        data_args.streaming or data_args.seq_length_buckets is not None
+    ):
+        raise ValueError(
+            "`--shuffle_block_size` can't be combined with `--streaming` or `--seq_length_buckets`, those have their"
+            " own shuffling."
+        )
+
+    if data_args.premasked_dir is not None and (
+        data_args.streaming
+        or training_args.device_collation
+        or training_args.collator_workers > 0
+        or data_args.span_mask_bank is not None
+    ):
+        raise ValueError(
+            "`--premasked_dir` can't be combined with `--streaming`, `--device_collation`, `--collator_workers` or"
+            " `--span_mask_bank`, its examples are already span-corrupted."
+        )
+
+    if data_args.seq_length_buckets is not None and (
+        data_args.streaming
+        or data_args.token_store is not None
+        or data_args.preprocessing_cache_dir is not None
+        or data_args.premasked_dir is not None
+        or data_args.span_mask_bank is not None
+        or training_args.collator_workers > 0
+        or training_args.device_collation
+    ):
+        raise ValueError(
+            "`--seq_length_buckets` can't be combined with `--streaming`, `--token_store`,"
+            " `--preprocessing_cache_dir`, `--premasked_dir`, `--span_mask_bank`, `--collator_workers` or"
+            " `--device_collation`, those work on sequences of a single length."
+        )
+
+    if data_args.segment_packing and (
+        data_args.streaming
+        or data_args.token_store is not None
+        or data_args.preprocessing_cache_dir is not None
+        or data_args.premasked_dir is not None
+        or data_args.seq_length_buckets is not None
+        or training_args.collator_workers > 0
+        or training_args.device_collation
+    ):
+        raise ValueError(
+            "`--segment_packing` can't be combined with `--streaming`, `--token_store`, `--preprocessing_cache_dir`,"
+            " `--premasked_dir`, `--seq_length_buckets`, `--collator_workers` or `--device_collation`, those don't"
+            " carry the segment ids of the packed tokens."
+        )
+
     # Setup logging
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -667,131 +2180,25 @@ def train_model(args):
             repo_name = training_args.hub_model_id
         repo = Repository(training_args.output_dir, clone_from=repo_name)
 
-    # Get the datasets: you can either provide your own CSV/JSON/TXT training and evaluation files (see below)
-    # or just provide the name of one of the public datasets available on the hub at https://huggingface.co/datasets/
-    # (the dataset will be downloaded automatically from the datasets Hub).
-    #
-    # For CSV/JSON files, this script will use the column called 'text' or the first column if no column called
-    # 'text' is found. You can easily tweak this behavior (see below).
-    if data_args.dataset_name is not None:
-        # Downloading and loading a dataset from the hub.
-        datasets = load_dataset(
-            data_args.dataset_name,
-            data_args.dataset_config_name,
-            cache_dir=model_args.cache_dir,
-            use_auth_token=True if model_args.use_auth_token else None,
-        )
+    # Load pretrained model and tokenizer. The datasets are only loaded (see `load_packed_datasets`) when the packed
+    # sequences are neither read from a token store nor from the preprocessing cache.
+    tokenizer = load_tokenizer(model_args)
+    config = load_config(model_args, tokenizer)
 
-        if "validation" not in datasets.keys():
-            datasets["validation"] = load_dataset(
-                data_args.dataset_name,
-                data_args.dataset_config_name,
-                split=f"train[:{data_args.validation_split_percentage}%]",
-                cache_dir=model_args.cache_dir,
-                use_auth_token=True if model_args.use_auth_token else None,
-            )
-            datasets["train"] = load_dataset(
-                data_args.dataset_name,
-                data_args.dataset_config_name,
-                split=f"train[{data_args.validation_split_percentage}%:]",
-                cache_dir=model_args.cache_dir,
-                use_auth_token=True if model_args.use_auth_token else None,
-            )
-    else:
-        data_files = {}
-        if data_args.train_file is not None:
-            data_files["train"] = data_args.train_file
-        if data_args.validation_file is not None:
-            data_files["validation"] = data_args.validation_file
-        extension = data_args.train_file.split(".")[-1]
-        if extension == "txt":
-            extension = "text"
-        datasets = load_dataset(
-            extension,
-            data_files=data_files,
-            cache_dir=model_args.cache_dir,
-            use_auth_token=True if model_args.use_auth_token else None,
+    if data_args.seq_length_buckets is not None:
+        # bucketed sequences replace `max_seq_length`, the longest bucket takes its place below
+        bucket_lengths = sorted(
+            int(length) for length in data_args.seq_length_buckets.split(",")
         )
-
-        if "validation" not in datasets.keys():
-            datasets["validation"] = load_dataset(
-                extension,
-                data_files=data_files,
-                split=f"train[:{data_args.validation_split_percentage}%]",
-                cache_dir=model_args.cache_dir,
-                use_auth_token=True if model_args.use_auth_token else None,
-            )
-            datasets["train"] = load_dataset(
-                extension,
-                data_files=data_files,
-                split=f"train[{data_args.validation_split_percentage}%:]",
-                cache_dir=model_args.cache_dir,
-                use_auth_token=True if model_args.use_auth_token else None,
+        if bucket_lengths[-1] > tokenizer.model_max_length:
+            raise ValueError(
+                f"The longest sequence length bucket ({bucket_lengths[-1]}) is longer than the maximum length of"
+                f" the model ({tokenizer.model_max_length})."
             )
-    # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
-    # https://huggingface.co/docs/datasets/loading_datasets.html.
-
-    # Load pretrained model and tokenizer
-
-    if model_args.tokenizer_name:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_args.tokenizer_name,
-            cache_dir=model_args.cache_dir,
-            use_fast=model_args.use_fast_tokenizer,
-            use_auth_token=True if model_args.use_auth_token else None,
-        )
-    elif model_args.model_name_or_path:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_args.model_name_or_path,
-            cache_dir=model_args.cache_dir,
-            use_fast=model_args.use_fast_tokenizer,
-            use_auth_token=True if model_args.use_auth_token else None,
-        )
-    else:
-        raise ValueError(
-            "You are instantiating a new tokenizer from scratch. This is not supported by this script."
-            "You can do it from another script, save it, and load it from here, using --tokenizer_name."
-        )
-
-    if model_args.config_name:
-        config = T5Config.from_pretrained(
-            model_args.config_name,
-            cache_dir=model_args.cache_dir,
-            vocab_size=len(tokenizer),
-            use_auth_token=True if model_args.use_auth_token else None,
-        )
-    elif model_args.model_name_or_path:
-        config = T5Config.from_pretrained(
-            model_args.model_name_or_path,
-            cache_dir=model_args.cache_dir,
-            use_auth_token=True if model_args.use_auth_token else None,
-        )
-    else:
-        config = CONFIG_MAPPING[model_args.model_type]()
-        logger.warning("You are instantiating a new config instance from scratch.")
-
-    # Preprocessing the datasets.
-    # First we tokenize all the texts.
-    if training_args.do_train:
-        column_names = datasets["train"].column_names
+        max_seq_length = bucket_lengths[-1]
     else:
-        column_names = datasets["validation"].column_names
-    text_column_name = "text" if "text" in column_names else column_names[0]
-
-    max_seq_length = min(data_args.max_seq_length, tokenizer.model_max_length)
-
-    # Otherwise, we tokenize every text, then concatenate them together before splitting them in smaller parts.
-    # Since we make sure that all sequences are of the same length, no attention_mask is needed.
-    def tokenize_function(examples):
-        return tokenizer(examples[text_column_name], return_attention_mask=False)
-
-    tokenized_datasets = datasets.map(
-        tokenize_function,
-        batched=True,
-        num_proc=data_args.preprocessing_num_workers,
-        remove_columns=column_names,
-        load_from_cache_file=not data_args.overwrite_cache,
-    )
+        bucket_lengths = None
+        max_seq_length = min(data_args.max_seq_length, tokenizer.model_max_length)
 
     # T5-like span masked language modeling will fuse consecutively masked tokens to a single sentinel token.
     # To ensure that the input length is `max_seq_length`, we need to increase the maximum length
@@ -802,39 +2209,58 @@ def train_model(args):
         mean_noise_span_length=data_args.mean_noise_span_length,
     )
 
-    # Main data processing function that will concatenate all texts from our dataset and generate chunks of expanded_inputs_length.
-    def group_texts(examples):
-        # Concatenate all texts.
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
-        # customize this part to your needs.
-        if total_length >= expanded_inputs_length:
-            total_length = (
-                total_length // expanded_inputs_length
-            ) * expanded_inputs_length
-        # Split by chunks of max_len.
-        result = {
-            k: [
-                t[i : i + expanded_inputs_length]
-                for i in range(0, total_length, expanded_inputs_length)
-            ]
-            for k, t in concatenated_examples.items()
+    if bucket_lengths is not None:
+        # (expanded inputs length, targets length) of every bucket, by input length
+        bucket_input_and_target_lengths = {
+            input_length: compute_input_and_target_lengths(
+                inputs_length=input_length,
+                noise_density=data_args.mlm_probability,
+                mean_noise_span_length=data_args.mean_noise_span_length,
+            )
+            for input_length in bucket_lengths
         }
-        return result
-
-    # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a
-    # remainder for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value
-    # might be slower to preprocess.
-    #
-    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
-    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
-    tokenized_datasets = tokenized_datasets.map(
-        group_texts,
-        batched=True,
-        num_proc=data_args.preprocessing_num_workers,
-        load_from_cache_file=not data_args.overwrite_cache,
-    )
+        bucket_datasets = tokenize_and_bucket(
+            load_raw_datasets(model_args, data_args),
+            tokenizer,
+            data_args,
+            {
+                input_length: lengths[0]
+                for input_length, lengths in bucket_input_and_target_lengths.items()
+            },
+        )
+    elif data_args.streaming:
+        # the train split is tokenized and packed on the fly during training (see `stream_train_batches`), only the
+        # validation sequences are kept in memory
+        streaming_datasets = load_streaming_datasets(model_args, data_args)
+        if "validation" not in streaming_datasets:
+            raise ValueError(
+                "`--streaming` needs a validation split, pass `--validation_file` or a dataset having one."
+            )
+        validation_sequences = packed_sequences(
+            example_texts(streaming_datasets["validation"]),
+            tokenizer,
+            expanded_inputs_length,
+        )
+        validation_sequences = list(
+            islice(validation_sequences, data_args.max_eval_samples)
+        )
+        if not validation_sequences:
+            raise ValueError(
+                f"The validation split is too short to pack a single sequence of {expanded_inputs_length} tokens."
+            )
+        tokenized_datasets = {"validation": np.stack(validation_sequences)}
+    elif data_args.token_store_mixture is not None:
+        # every batch mixes rows of the train splits of the stores at their weights, see `WeightedMixtureBatchSplits`
+        mixture_datasets, mixture_weights = load_token_store_mixture(
+            data_args, tokenizer, expanded_inputs_length
+        )
+    elif data_args.premasked_dir is not None:
+        # training and evaluation read examples corrupted by `ptlm pre-mask`, the data collator is not used
+        tokenized_datasets = PremaskedDataset.load_splits(data_args.premasked_dir)
+    else:
+        tokenized_datasets = load_packed_datasets(
+            model_args, data_args, tokenizer, expanded_inputs_length
+        )
 
     # Enable tensorboard only on the master node
     has_tensorboard = is_tensorboard_available()
@@ -886,6 +2312,61 @@ def train_model(args):
         decoder_start_token_id=model.config.decoder_start_token_id,
     )
 
+    if training_args.device_collation:
+        device_collator = FlaxDeviceDataCollatorForT5MLM(
+            vocab_size=len(tokenizer),
+            eos_token_id=tokenizer.eos_token_id,
+            noise_density=data_args.mlm_probability,
+            mean_noise_span_length=data_args.mean_noise_span_length,
+            input_length=max_seq_length,
+            target_length=targets_length,
+            decoder_start_token_id=model.config.decoder_start_token_id,
+        )
+        rng, mask_rng = jax.random.split(rng)
+
+    if data_args.span_mask_bank is not None:
+
+        def build_span_mask_bank():
+            logger.info(
+                f"Generating {data_args.span_mask_bank_size} span masks into {data_args.span_mask_bank}"
+            )
+            SpanMaskBank.build(
+                data_args.span_mask_bank,
+                data_collator,
+                expanded_inputs_length,
+                data_args.span_mask_bank_size,
+                seed=training_args.seed,
+            )
+
+        # only the first host builds the bank, hosts sharing a filesystem would race on the same temporary directory
+        if jax.process_index() == 0 and not os.path.exists(data_args.span_mask_bank):
+            build_span_mask_bank()
+        multihost_utils.sync_global_devices("span_mask_bank")
+        # the bank only depends on its arguments, hosts that don't see the first host's bank build the same one
+        if not os.path.exists(data_args.span_mask_bank):
+            build_span_mask_bank()
+        mask_bank = SpanMaskBank(data_args.span_mask_bank)
+        mask_bank.check_compatible(data_collator, expanded_inputs_length)
+        data_collator = data_collator.replace(mask_bank=mask_bank)
+
+    if bucket_lengths is not None:
+        # every bucket gets a collator corrupting sequences of its own length
+        bucket_collators = {
+            input_length: data_collator.replace(
+                input_length=input_length, target_length=lengths[1]
+            )
+            for input_length, lengths in bucket_input_and_target_lengths.items()
+        }
+
+    if data_args.premasked_dir is not None:
+        for premasked_dataset in tokenized_datasets.values():
+            premasked_dataset.check_compatible(data_collator)
+        if int(training_args.num_train_epochs) > tokenized_datasets["train"].num_epochs:
+            logger.warning(
+                f"Training for {int(training_args.num_train_epochs)} epochs on"
+                f" {tokenized_datasets['train'].num_epochs} pre-masked epochs, the pre-masked epochs will be reused."
+            )
+
     # Store some constant
     num_epochs = int(training_args.num_train_epochs)
     train_batch_size = (
@@ -894,10 +2375,29 @@ def train_model(args):
     per_device_eval_batch_size = int(training_args.per_device_eval_batch_size)
     eval_batch_size = per_device_eval_batch_size * jax.device_count()
 
-    num_train_steps = len(tokenized_datasets["train"]) // train_batch_size * num_epochs
+    if data_args.streaming or data_args.token_store_mixture is not None:
+        num_epochs = 1
+        num_train_steps = training_args.max_train_steps
+    elif bucket_lengths is not None:
+        num_train_steps = num_epochs * sum(
+            len(bucket_datasets[input_length]["train"]) // train_batch_size
+            for input_length in bucket_lengths
+        )
+    else:
+        num_train_steps = (
+            len(tokenized_datasets["train"]) // train_batch_size * num_epochs
+        )
 
     num_of_hosts = jax.process_count()
     current_host_idx = jax.process_index()
+    # each host only fetches and collates its own slice of every global batch
+    local_train_batch_size = train_batch_size // num_of_hosts
+    # noise masks are keyed by (seed, epoch, step, row in the global batch), so a host's slice gets the rows it
+    # would have in a batch collated as a whole
+    local_row_offset = current_host_idx * local_train_batch_size
+
+    # the bucket epoch permutations must be the same on all hosts, keep them on their own stream
+    sampling_rng = np.random.RandomState(training_args.seed)
 
     # Create learning rate schedule
     warmup_fn = optax.linear_schedule(
@@ -957,6 +2457,13 @@ def train_model(args):
         apply_fn=model.__call__, params=model.params, tx=optimizer
     )
 
+    def token_mean(values, batch):
+        # with `--segment_packing`, tokens of segment 0 are padding and don't count
+        if "decoder_segment_ids" not in batch:
+            return values.mean()
+        weights = batch["decoder_segment_ids"] > 0
+        return (values * weights).sum() / jnp.maximum(weights.sum(), 1)
+
     # Define gradient update step fn
     def train_step(state, batch, dropout_rng):
         dropout_rng, new_dropout_rng = jax.random.split(dropout_rng)
@@ -964,14 +2471,20 @@ def train_model(args):
         def loss_fn(params):
             labels = batch.pop("labels")
 
-            logits = state.apply_fn(
-                **batch, params=params, dropout_rng=dropout_rng, train=True
-            )[0]
+            if data_args.segment_packing:
+                logits = segment_logits(
+                    model, params, batch, dropout_rng=dropout_rng, train=True
+                )
+            else:
+                logits = state.apply_fn(
+                    **batch, params=params, dropout_rng=dropout_rng, train=True
+                )[0]
 
             # compute loss
-            loss = optax.softmax_cross_entropy(
-                logits, onehot(labels, logits.shape[-1])
-            ).mean()
+            loss = token_mean(
+                optax.softmax_cross_entropy(logits, onehot(labels, logits.shape[-1])),
+                batch,
+            )
 
             return loss
 
@@ -990,11 +2503,20 @@ def train_model(args):
     # Create parallel version of the train step
     p_train_step = jax.pmap(train_step, "batch", donate_argnums=(0,))
 
+    # Span corruption on the devices, see `--device_collation`
+    def collate_step(rng, batch):
+        return device_collator(rng, batch["input_ids"])
+
+    p_collate_step = jax.pmap(collate_step, "batch")
+
     # Define eval fn
     def eval_step(params, batch):
         labels = batch.pop("labels")
 
-        logits = model(**batch, params=params, train=False)[0]
+        if data_args.segment_packing:
+            logits = segment_logits(model, params, batch)
+        else:
+            logits = model(**batch, params=params, train=False)[0]
 
         # compute loss
         loss = optax.softmax_cross_entropy(logits, onehot(labels, logits.shape[-1]))
@@ -1003,7 +2525,10 @@ def train_model(args):
         accuracy = jnp.equal(jnp.argmax(logits, axis=-1), labels)
 
         # summarize metrics
-        metrics = {"loss": loss.mean(), "accuracy": accuracy.mean()}
+        metrics = {
+            "loss": token_mean(loss, batch),
+            "accuracy": token_mean(accuracy, batch),
+        }
         metrics = jax.lax.pmean(metrics, axis_name="batch")
 
         return metrics
@@ -1013,134 +2538,353 @@ def train_model(args):
     # Replicate the train state on each device
     state = jax_utils.replicate(state)
 
-    train_time = 0
-    epochs = tqdm(range(num_epochs), desc="Epoch ... ", position=0)
-    for epoch in epochs:
-        # ======================== Training ================================
-        train_start = time.time()
-        train_metrics = []
-
-        # Create sampling rng
-        rng, input_rng = jax.random.split(rng)
-
-        # Generate an epoch by shuffling sampling indices from the train dataset
-        num_train_samples = len(tokenized_datasets["train"])
+    def fetch_segment_ids(dataset, batch_idx):
+        if not data_args.segment_packing:
+            return None
+        return fetch_input_ids(dataset, batch_idx, column="segment_ids")
+
+    def train_batch(epoch, step_and_batch):
+        # a streamed batch already holds the samples, others hold their indices in the train split, next to the input
+        # length of their bucket when bucketing
+        step, local_batch = step_and_batch
+        if data_args.premasked_dir is not None:
+            return shard(tokenized_datasets["train"].fetch(epoch, local_batch))
+        collator = data_collator
+        segment_ids = None
+        if data_args.streaming:
+            samples = local_batch
+        elif bucket_lengths is not None:
+            input_length, local_batch_idx = local_batch
+            samples = fetch_input_ids(
+                bucket_datasets[input_length]["train"], local_batch_idx
+            )
+            collator = bucket_collators[input_length]
+        elif data_args.token_store_mixture is not None:
+            sources, local_batch_idx = local_batch
+            samples = np.empty(
+                (len(local_batch_idx), expanded_inputs_length), dtype=np.int32
+            )
+            for source in np.unique(sources):
+                from_source = sources == source
+                samples[from_source] = fetch_input_ids(
+                    mixture_datasets[source]["train"], local_batch_idx[from_source]
+                )
+        else:
+            samples = fetch_input_ids(tokenized_datasets["train"], local_batch)
+            segment_ids = fetch_segment_ids(tokenized_datasets["train"], local_batch)
+        if training_args.device_collation:
+            return shard({"input_ids": samples})
+        model_inputs = collator(
+            samples,
+            rng_key=noise_rng_key(training_args.seed, epoch, step),
+            row_offset=local_row_offset,
+            segment_ids=segment_ids,
+        )
+        return shard(model_inputs.data)
+
+    def eval_batch_splits():
+        if data_args.token_store_mixture is not None:
+            # the batches of the validation split of every store in turn, with the store they come from
+            return [
+                (source, batch_idx)
+                for source, token_store in enumerate(mixture_datasets)
+                if len(token_store.get("validation", ())) > 0
+                for batch_idx in generate_batch_splits(
+                    np.arange(len(token_store["validation"])),
+                    eval_batch_size,
+                    drop_last=False,
+                )
+            ]
+        if bucket_lengths is not None:
+            # the batches of every bucket in turn, with the input length of their bucket
+            return [
+                (input_length, batch_idx)
+                for input_length in bucket_lengths
+                if len(bucket_datasets[input_length]["validation"]) > 0
+                for batch_idx in generate_batch_splits(
+                    np.arange(len(bucket_datasets[input_length]["validation"])),
+                    eval_batch_size,
+                    drop_last=False,
+                )
+            ]
+        num_eval_samples = len(tokenized_datasets["validation"])
         # Avoid using jax.numpy here in case of TPU training
-        train_samples_idx = np.random.permutation(np.arange(num_train_samples))
-        train_batch_idx = generate_batch_splits(train_samples_idx, train_batch_size)
-
-        # Gather the indexes for creating the batch and do a training step
-        for step, batch_idx in enumerate(
-            tqdm(train_batch_idx, desc="Training...", position=1)
-        ):
-            samples = [tokenized_datasets["train"][int(idx)] for idx in batch_idx]
-            model_inputs = data_collator(samples)
-
-            local_host_model_inputs = {
-                key: np.split(model_inputs.data[key], num_of_hosts, axis=0)[
-                    current_host_idx
-                ]
-                for key, value in model_inputs.data.items()
-            }
+        eval_samples_idx = np.arange(num_eval_samples)
+        return generate_batch_splits(eval_samples_idx, eval_batch_size, drop_last=False)
+
+    def eval_batch(batch_idx):
+        if data_args.premasked_dir is not None:
+            return tokenized_datasets["validation"].fetch(0, batch_idx)
+        if data_args.token_store_mixture is not None:
+            source, batch_idx = batch_idx
+            samples = fetch_input_ids(mixture_datasets[source]["validation"], batch_idx)
+            return data_collator(samples).data
+        if bucket_lengths is not None:
+            input_length, batch_idx = batch_idx
+            samples = fetch_input_ids(
+                bucket_datasets[input_length]["validation"], batch_idx
+            )
+            return bucket_collators[input_length](samples).data
+        samples = fetch_input_ids(tokenized_datasets["validation"], batch_idx)
+        return data_collator(
+            samples,
+            segment_ids=fetch_segment_ids(tokenized_datasets["validation"], batch_idx),
+        ).data
+
+    if data_args.streaming:
+        host_train_stream = load_host_train_stream(
+            model_args,
+            data_args,
+            streaming_datasets["train"],
+            current_host_idx,
+            num_of_hosts,
+        )
 
-            # Model forward
-            model_inputs = shard(local_host_model_inputs)
-            state, train_metric, dropout_rngs = p_train_step(
-                state, model_inputs, dropout_rngs
+    def stream_train_batches(stream_pass):
+        # every host packs its own share of the documents into its slice of the global batches, and reshuffles them
+        # on every pass over the stream
+        if host_train_stream is not None:
+            documents = host_train_stream
+        else:
+            documents = islice(
+                streaming_datasets["train"], current_host_idx, None, num_of_hosts
+            )
+        sequences = shuffle_buffer(
+            packed_sequences(
+                example_texts(documents), tokenizer, expanded_inputs_length
+            ),
+            data_args.shuffle_buffer_size,
+            np.random.RandomState([training_args.seed, current_host_idx, stream_pass]),
+        )
+        num_batches = 0
+        for batch in stack_batches(sequences, local_train_batch_size):
+            num_batches += 1
+            yield batch
+        # the stream would otherwise start over forever without ever making a step
+        if num_batches == 0:
+            raise ValueError(
+                f"The share of the train split of host {current_host_idx} is too short to pack a single batch of"
+                f" {local_train_batch_size} sequences of {expanded_inputs_length} tokens."
             )
-            train_metrics.append(train_metric)
 
-            cur_step = epoch * (num_train_samples // train_batch_size) + step
+    # the collator pool is closed however training ends, so that its workers and shared memory never outlive it
+    with contextlib.ExitStack() as exit_stack:
+        if training_args.collator_workers > 0:
+            collator_pool = exit_stack.enter_context(
+                CollatorPool(
+                    tokenized_datasets["train"],
+                    data_collator,
+                    local_train_batch_size,
+                    num_workers=training_args.collator_workers,
+                    ring_size=training_args.collator_ring_size,
+                    seed=training_args.seed,
+                    row_offset=local_row_offset,
+                )
+            )
 
-            if cur_step % training_args.logging_steps == 0 and cur_step > 0:
-                # Save metrics
-                train_metric = jax_utils.unreplicate(train_metric)
-                train_time += time.time() - train_start
-                if has_tensorboard and jax.process_index() == 0:
-                    write_train_metric(
-                        summary_writer, train_metrics, train_time, cur_step
+        train_time = 0
+        epochs = tqdm(range(num_epochs), desc="Epoch ... ", position=0)
+        for epoch in epochs:
+            # ======================== Training ================================
+            train_start = time.time()
+            train_metrics = []
+
+            # Create sampling rng
+            rng, input_rng = jax.random.split(rng)
+
+            if data_args.streaming:
+                # the stream starts over when it runs out before the last step, so all hosts make the same steps
+                local_train_batches = islice(
+                    chain.from_iterable(map(stream_train_batches, count())),
+                    num_train_steps,
+                )
+                num_epoch_steps = num_train_steps
+            elif data_args.token_store_mixture is not None:
+                # the batch of every step is computed from the step alone, sources are reshuffled as they run out
+                local_train_batches = WeightedMixtureBatchSplits(
+                    [len(token_store["train"]) for token_store in mixture_datasets],
+                    mixture_weights,
+                    train_batch_size,
+                    num_train_steps,
+                    seed=training_args.seed,
+                    num_hosts=num_of_hosts,
+                    host=current_host_idx,
+                )
+                num_epoch_steps = num_train_steps
+            elif bucket_lengths is not None:
+                # shuffle every bucket on its own, then interleave the batches of all buckets in a random order drawn
+                # from the same stream on all hosts. pmap compiles the train step once per bucket length and reuses it,
+                # so the number of compilations is bounded by the number of buckets whatever the order.
+                local_train_batches = []
+                for input_length in bucket_lengths:
+                    num_train_samples = len(bucket_datasets[input_length]["train"])
+                    train_samples_idx = sampling_rng.permutation(
+                        np.arange(num_train_samples)
+                    )
+                    train_batch_idx = generate_batch_splits(
+                        train_samples_idx, train_batch_size
+                    )
+                    local_train_batches.extend(
+                        (input_length, local_batch_idx)
+                        for local_batch_idx in np.split(
+                            train_batch_idx, num_of_hosts, axis=1
+                        )[current_host_idx]
+                    )
+                local_train_batches = [
+                    local_train_batches[i]
+                    for i in sampling_rng.permutation(len(local_train_batches))
+                ]
+                num_epoch_steps = len(local_train_batches)
+            else:
+                # Generate an epoch by shuffling sampling indices from the train dataset. The permutation is keyed by the
+                # seed and the epoch and evaluated batch by batch, so it takes no memory, is the same on all hosts and
+                # any step can be computed without the previous ones.
+                num_train_samples = len(tokenized_datasets["train"])
+                if data_args.shuffle_block_size is not None:
+                    train_permutation = BlockShufflePermutation(
+                        num_train_samples,
+                        data_args.shuffle_block_size,
+                        data_args.shuffle_window_blocks,
+                        seed=[training_args.seed, epoch],
+                    )
+                else:
+                    train_permutation = FeistelPermutation(
+                        num_train_samples, seed=[training_args.seed, epoch]
+                    )
+                local_train_batches = LazyBatchSplits(
+                    train_permutation,
+                    train_batch_size,
+                    num_hosts=num_of_hosts,
+                    host=current_host_idx,
+                )
+                num_epoch_steps = len(local_train_batches)
+
+            # Gather the indexes for creating the batch and do a training step
+            epoch_train_batch = partial(train_batch, epoch)
+            if training_args.collator_workers > 0:
+                # batches are views on the shared ring buffer, copy them to the devices before the slot is reused
+                train_batches = (
+                    device_put_batch(shard(model_inputs))
+                    for model_inputs in collator_pool.iterate(
+                        local_train_batches, epoch
+                    )
+                )
+            elif training_args.prefetch:
+                # collate on background threads and keep the next batches already transferred to the devices
+                train_batches = jax_utils.prefetch_to_device(
+                    prefetch(
+                        enumerate(local_train_batches),
+                        epoch_train_batch,
+                        training_args.prefetch_depth,
+                        num_workers=training_args.prefetch_workers,
+                    ),
+                    training_args.prefetch_depth,
+                )
+            else:
+                train_batches = map(epoch_train_batch, enumerate(local_train_batches))
+
+            for step, model_inputs in enumerate(
+                tqdm(
+                    train_batches,
+                    total=num_epoch_steps,
+                    desc="Training...",
+                    position=1,
+                )
+            ):
+                if training_args.device_collation:
+                    # one key per device of the global batch, this host takes the keys of its own devices
+                    collate_rngs = jax.random.split(
+                        jax.random.fold_in(jax.random.fold_in(mask_rng, epoch), step),
+                        jax.device_count(),
+                    )
+                    model_inputs = p_collate_step(
+                        np.split(collate_rngs, num_of_hosts)[current_host_idx],
+                        model_inputs,
                     )
 
-                epochs.write(
-                    f"Step... ({cur_step} | Loss: {train_metric['loss'].mean()}, Learning Rate:"
-                    f" {train_metric['learning_rate'].mean()})"
+                # Model forward
+                state, train_metric, dropout_rngs = p_train_step(
+                    state, model_inputs, dropout_rngs
                 )
+                train_metrics.append(train_metric)
 
-                train_metrics = []
+                cur_step = epoch * num_epoch_steps + step
 
-            if cur_step % training_args.eval_steps == 0 and cur_step > 0:
-                # ======================== Evaluating ==============================
-                num_eval_samples = len(tokenized_datasets["validation"])
-                # Avoid using jax.numpy here in case of TPU training
-                eval_samples_idx = np.arange(num_eval_samples)
-                eval_batch_idx = generate_batch_splits(
-                    eval_samples_idx, eval_batch_size, drop_last=False
-                )
+                if cur_step % training_args.logging_steps == 0 and cur_step > 0:
+                    # Save metrics
+                    train_metric = jax_utils.unreplicate(train_metric)
+                    train_time += time.time() - train_start
+                    if has_tensorboard and jax.process_index() == 0:
+                        write_train_metric(
+                            summary_writer, train_metrics, train_time, cur_step
+                        )
 
-                eval_metrics = []
-                for i, batch_idx in enumerate(
-                    tqdm(eval_batch_idx, desc="Evaluating ...", position=2)
-                ):
-                    samples = [
-                        tokenized_datasets["validation"][int(idx)] for idx in batch_idx
-                    ]
-                    model_inputs = data_collator(samples)
-
-                    # Model forward
-                    metrics = pad_shard_unpad(p_eval_step, static_return=True)(
-                        state.params,
-                        model_inputs.data,
-                        min_device_batch=per_device_eval_batch_size,
+                    epochs.write(
+                        f"Step... ({cur_step} | Loss: {train_metric['loss'].mean()}, Learning Rate:"
+                        f" {train_metric['learning_rate'].mean()})"
                     )
-                    eval_metrics.append(metrics)
 
-                # get eval metrics
-                eval_metrics = get_metrics(eval_metrics)
-                eval_metrics = jax.tree_util.tree_map(jnp.mean, eval_metrics)
+                    train_metrics = []
 
-                # Update progress bar
-                epochs.write(
-                    f"Step... ({cur_step} | Loss: {eval_metrics['loss']}, Acc: {eval_metrics['accuracy']})"
-                )
+                if cur_step % training_args.eval_steps == 0 and cur_step > 0:
+                    # ======================== Evaluating ==============================
+                    eval_batch_idx = eval_batch_splits()
+
+                    eval_metrics = []
+                    for i, batch_idx in enumerate(
+                        tqdm(eval_batch_idx, desc="Evaluating ...", position=2)
+                    ):
+                        model_inputs = eval_batch(batch_idx)
 
-                # Save metrics
-                if has_tensorboard and jax.process_index() == 0:
-                    write_eval_metric(summary_writer, eval_metrics, cur_step)
+                        # Model forward
+                        metrics = pad_shard_unpad(p_eval_step, static_return=True)(
+                            state.params,
+                            model_inputs,
+                            min_device_batch=per_device_eval_batch_size,
+                        )
+                        eval_metrics.append(metrics)
+
+                    # get eval metrics
+                    eval_metrics = get_metrics(eval_metrics)
+                    eval_metrics = jax.tree_util.tree_map(jnp.mean, eval_metrics)
 
-            if cur_step % training_args.save_steps == 0 and cur_step > 0:
-                # save checkpoint after each epoch and push checkpoint to the hub
-                if jax.process_index() == 0:
-                    params = jax.device_get(
-                        jax.tree_util.tree_map(lambda x: x[0], state.params)
+                    # Update progress bar
+                    epochs.write(
+                        f"Step... ({cur_step} | Loss: {eval_metrics['loss']}, Acc: {eval_metrics['accuracy']})"
                     )
-                    model.save_pretrained(training_args.output_dir, params=params)
-                    tokenizer.save_pretrained(training_args.output_dir)
-                    if training_args.push_to_hub:
-                        repo.push_to_hub(
-                            commit_message=f"Saving weights and logs of step {cur_step}",
-                            blocking=False,
+
+                    # Save metrics
+                    if has_tensorboard and jax.process_index() == 0:
+                        write_eval_metric(summary_writer, eval_metrics, cur_step)
+
+                if cur_step % training_args.save_steps == 0 and cur_step > 0:
+                    # save checkpoint after each epoch and push checkpoint to the hub
+                    if jax.process_index() == 0:
+                        params = jax.device_get(
+                            jax.tree_util.tree_map(lambda x: x[0], state.params)
                         )
+                        model.save_pretrained(training_args.output_dir, params=params)
+                        tokenizer.save_pretrained(training_args.output_dir)
+                        if training_args.push_to_hub:
+                            repo.push_to_hub(
+                                commit_message=f"Saving weights and logs of step {cur_step}",
+                                blocking=False,
+                            )
 
     # Eval after training
     if training_args.do_eval:
-        num_eval_samples = len(tokenized_datasets["validation"])
-        # Avoid using jax.numpy here in case of TPU training
-        eval_samples_idx = np.arange(num_eval_samples)
-        eval_batch_idx = generate_batch_splits(
-            eval_samples_idx, eval_batch_size, drop_last=False
-        )
+        eval_batch_idx = eval_batch_splits()
 
         eval_metrics = []
         for i, batch_idx in enumerate(
             tqdm(eval_batch_idx, desc="Evaluating ...", position=2)
         ):
-            samples = [tokenized_datasets["validation"][int(idx)] for idx in batch_idx]
-            model_inputs = data_collator(samples)
+            model_inputs = eval_batch(batch_idx)
 
             # Model forward
             metrics = pad_shard_unpad(p_eval_step, static_return=True)(
                 state.params,
-                model_inputs.data,
+                model_inputs,
                 min_device_batch=per_device_eval_batch_size,
             )
             eval_metrics.append(metrics)
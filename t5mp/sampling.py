@@ -0,0 +1,237 @@
+"""Shuffled orders of the training samples, computed lazily batch by batch."""
+import numpy as np
+
+
+class FeistelPermutation:
+    """
+    Seeded pseudo-random permutation of `range(size)` evaluated element by element, in O(1) memory whatever the size.
+    Indices are enciphered by a balanced Feistel network over the smallest even number of bits covering `size`, which
+    is a bijection of that power-of-two range. Values falling outside of `range(size)` are enciphered again until
+    they fall inside (cycle walking), which keeps the bijection on `range(size)` and takes less than 4 rounds of the
+    network on average since the power-of-two range is less than 4 times `size`.
+
+    Args:
+        size (:obj:`int`):
+            Number of elements permuted.
+        seed:
+            Anything `numpy.random.SeedSequence` takes, e.g. `[seed, epoch]`, the round keys are derived from it.
+        num_rounds (:obj:`int`):
+            Number of rounds of the Feistel network.
+    """
+
+    def __init__(self, size, seed, num_rounds=4):
+        self.size = int(size)
+        self.half_bits = max(-(-max(size - 1, 1).bit_length() // 2), 1)
+        self.half_mask = np.uint64((1 << self.half_bits) - 1)
+        self.round_keys = np.random.SeedSequence(seed).generate_state(
+            num_rounds, np.uint64
+        )
+
+    def __len__(self):
+        return self.size
+
+    def _round_function(self, values, key):
+        # splitmix64 finalizer of the half block offset by the round key
+        x = values + key
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+        return x & self.half_mask
+
+    def _encipher(self, values):
+        half_bits = np.uint64(self.half_bits)
+        left, right = values >> half_bits, values & self.half_mask
+        for key in self.round_keys:
+            left, right = right, left ^ self._round_function(right, key)
+        return (left << half_bits) | right
+
+    def __getitem__(self, indices) -> np.ndarray:
+        """The elements at positions `indices` (an int or an array of ints) of the permutation, as int64."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.size):
+            raise IndexError(
+                f"Permutation indices must be in [0, {self.size}), got [{indices.min()}, {indices.max()}]."
+            )
+        values = self._encipher(indices.astype(np.uint64).reshape(-1))
+        outside = values >= np.uint64(self.size)
+        while outside.any():
+            values[outside] = self._encipher(values[outside])
+            outside = values >= np.uint64(self.size)
+        return values.astype(np.int64).reshape(indices.shape)
+
+
+class LazyBatchSplits:
+    """
+    Lazy version of `generate_batch_splits` over an epoch permutation (e.g. a `FeistelPermutation`): batch `step`
+    holds the elements of the permutation at positions `[step * batch_size, (step + 1) * batch_size)`, the last
+    incomplete batch is dropped. With `num_hosts`, batches only hold the `batch_size // num_hosts` columns of `host`,
+    like splitting the batch splits along their second axis. Batches are computed on demand, so any step can be
+    jumped to without going over the previous ones.
+    """
+
+    def __init__(self, permutation, batch_size, num_hosts=1, host=0):
+        self.permutation = permutation
+        self.batch_size = batch_size
+        self.local_batch_size = batch_size // num_hosts
+        self.host_offset = host * self.local_batch_size
+
+    def __len__(self):
+        return len(self.permutation) // self.batch_size
+
+    def batch(self, step) -> np.ndarray:
+        """The sample indices of this host in the batch `step`."""
+        if not 0 <= step < len(self):
+            raise IndexError(f"Step {step} out of range for {len(self)} batches.")
+        start = step * self.batch_size + self.host_offset
+        return self.permutation[np.arange(start, start + self.local_batch_size)]
+
+    def __getitem__(self, step) -> np.ndarray:
+        return self.batch(step)
+
+    def __iter__(self):
+        return map(self.batch, range(len(self)))
+
+
+class BlockShufflePermutation:
+    """
+    Locality-aware permutation of `range(size)`: the rows are cut into blocks of `block_size` consecutive rows, the
+    blocks are shuffled, and the rows of every window of `window_blocks` consecutive blocks of the shuffled order are
+    shuffled together. Consecutive positions of the permutation, like the rows of a batch, are therefore read from a
+    bounded set of `window_blocks` contiguous ranges of the data, which keeps memory-mapped reads sequential enough
+    for the page cache and read-ahead, at the price of rows being correlated with the other rows of their window.
+    The last `size % block_size` rows don't make a block and are shuffled with the last window. Like
+    `FeistelPermutation`, it is evaluated element by element in O(1) memory.
+
+    Args:
+        size (:obj:`int`):
+            Number of elements permuted.
+        block_size (:obj:`int`):
+            Number of consecutive rows in a block.
+        window_blocks (:obj:`int`):
+            Number of blocks whose rows are shuffled together.
+        seed:
+            Anything `numpy.random.SeedSequence` takes, e.g. `[seed, epoch]`.
+    """
+
+    def __init__(self, size, block_size, window_blocks, seed):
+        self.size = size
+        self.block_size = block_size
+        self.window_blocks = window_blocks
+        self.seed = np.atleast_1d(seed).tolist()
+        self.num_blocks = size // block_size
+        self.num_windows = max(-(-self.num_blocks // window_blocks), 1)
+        self.window_rows = window_blocks * block_size
+        self.blocks = FeistelPermutation(self.num_blocks, self.seed + [0])
+
+    def __len__(self):
+        return self.size
+
+    def _window_size(self, window):
+        if window < self.num_windows - 1:
+            return self.window_rows
+        return self.size - window * self.window_rows
+
+    def __getitem__(self, indices) -> np.ndarray:
+        """The elements at positions `indices` (an int or an array of ints) of the permutation, as int64."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.size):
+            raise IndexError(
+                f"Permutation indices must be in [0, {self.size}), got [{indices.min()}, {indices.max()}]."
+            )
+        positions = indices.reshape(-1)
+        windows = np.minimum(positions // self.window_rows, self.num_windows - 1)
+        window_positions = np.empty_like(positions)
+        # consecutive positions share a window, so there are only a few windows to set up per call
+        for window in np.unique(windows).tolist():
+            in_window = windows == window
+            window_positions[in_window] = FeistelPermutation(
+                self._window_size(window), self.seed + [1, window]
+            )[positions[in_window] - window * self.window_rows]
+
+        slots = windows * self.window_blocks + window_positions // self.block_size
+        in_block = slots < self.num_blocks
+        rows = self.num_blocks * self.block_size + (
+            window_positions
+            - (self.num_blocks - windows * self.window_blocks) * self.block_size
+        )
+        rows[in_block] = (
+            self.blocks[slots[in_block]] * self.block_size
+            + window_positions[in_block] % self.block_size
+        )
+        return rows.reshape(indices.shape)
+
+
+class WeightedMixtureBatchSplits:
+    """
+    Batches of `batch_size` rows drawn from several sources of `sizes` rows at fixed `weights`, for `num_steps`
+    steps. Every batch is a pair of arrays, the source and the row in the source of every row of the batch.
+
+    Rows are allocated cumulatively: after `step` batches, every source but the one of the largest weight has
+    contributed `floor(step * batch_size * weight)` rows and the largest source the rest, so every batch is within
+    one row of the weights and the shares are exact over the run. The rows of every batch are shuffled by a
+    `FeistelPermutation` keyed by the seed and the step, so that the slice of every host and device draws from the
+    sources at the weights in expectation instead of holding the rows of mostly one source. Every source is read through its own
+    `FeistelPermutation` per pass over it, keyed by the seed, the source and the pass, so a source gets reshuffled
+    whenever it runs out, independently of the others. A batch only depends on its step, so any step can be computed
+    without the previous ones, e.g. to resume training, in O(1) memory. With `num_hosts`, batches only hold the
+    `batch_size // num_hosts` rows of `host`, like `LazyBatchSplits`.
+    """
+
+    def __init__(
+        self, sizes, weights, batch_size, num_steps, seed, num_hosts=1, host=0
+    ):
+        if len(sizes) != len(weights) or min(sizes) <= 0 or min(weights) <= 0:
+            raise ValueError(
+                f"Every source of a mixture needs rows and a positive weight, got sizes {sizes} and weights {weights}."
+            )
+        self.sizes = list(sizes)
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        self.largest = int(np.argmax(self.weights))
+        self.batch_size = batch_size
+        self.num_steps = num_steps
+        self.seed = np.atleast_1d(seed).tolist()
+        self.local_batch_size = batch_size // num_hosts
+        self.host_offset = host * self.local_batch_size
+
+    def __len__(self):
+        return self.num_steps
+
+    def rows_drawn(self, step) -> np.ndarray:
+        """Number of rows drawn from every source by the first `step` batches."""
+        num_rows = step * self.batch_size
+        drawn = np.floor(num_rows * self.weights).astype(np.int64)
+        drawn[self.largest] = num_rows - (drawn.sum() - drawn[self.largest])
+        return drawn
+
+    def batch(self, step):
+        """The sources and the rows in their source of the rows of this host in the batch `step`."""
+        if not 0 <= step < len(self):
+            raise IndexError(f"Step {step} out of range for {len(self)} batches.")
+        start, stop = self.rows_drawn(step), self.rows_drawn(step + 1)
+        sources, rows = [], []
+        for source, size in enumerate(self.sizes):
+            positions = np.arange(start[source], stop[source])
+            passes = positions // size
+            source_rows = np.empty_like(positions)
+            # a batch usually spans one or two passes over a source, more when the source has fewer rows than its
+            # share of a batch
+            for source_pass in np.unique(passes).tolist():
+                in_pass = passes == source_pass
+                source_rows[in_pass] = FeistelPermutation(
+                    size, self.seed + [source, source_pass]
+                )[positions[in_pass] % size]
+            sources.append(np.full(len(positions), source))
+            rows.append(source_rows)
+        # the rows come grouped by source, they are shuffled before every host takes its slice of the batch
+        order = FeistelPermutation(self.batch_size, self.seed + [step])[
+            np.arange(self.host_offset, self.host_offset + self.local_batch_size)
+        ]
+        return np.concatenate(sources)[order], np.concatenate(rows)[order]
+
+    def __getitem__(self, step):
+        return self.batch(step)
+
+    def __iter__(self):
+        return map(self.batch, range(len(self)))
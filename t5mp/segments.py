@@ -0,0 +1,150 @@
+"""Attention masking of sequences packed from several documents, keyed by the segment ids of their tokens."""
+import contextlib
+
+import jax.numpy as jnp
+from transformers.models.t5 import modeling_flax_t5
+from transformers.models.t5.modeling_flax_t5 import FlaxT5Attention
+
+
+class FlaxT5SegmentAttention(FlaxT5Attention):
+    """
+    `FlaxT5Attention` also taking block attention masks of shape `[batch_size, 1, query_length, key_length]`, see
+    `segment_masks`. `FlaxT5Attention` only broadcasts padding masks of shape `[batch_size, key_length]`. The first
+    layer of a stack adds the mask to its position bias, which the following layers reuse as is, so only the first
+    layer ever reads it. Padding masks go through `FlaxT5Attention` unchanged.
+    """
+
+    def __call__(
+        self,
+        hidden_states,
+        attention_mask=None,
+        key_value_states=None,
+        position_bias=None,
+        use_cache=False,
+        output_attentions=False,
+        deterministic=True,
+        init_cache=False,
+    ):
+        if attention_mask is not None and attention_mask.ndim == 4:
+            if position_bias is None:
+                query_length = hidden_states.shape[1]
+                key_length = (
+                    hidden_states if key_value_states is None else key_value_states
+                ).shape[1]
+                if self.has_relative_attention_bias:
+                    position_bias = self.compute_bias(query_length, key_length)
+                else:
+                    position_bias = jnp.zeros(
+                        (1, self.n_heads, query_length, key_length), dtype=self.dtype
+                    )
+                position_bias = position_bias + jnp.where(
+                    attention_mask > 0, 0.0, jnp.finfo(self.dtype).min
+                ).astype(self.dtype)
+            # the position bias carries the mask now, the causal branch of `FlaxT5Attention` still needs a padding mask
+            attention_mask = (
+                jnp.ones(hidden_states.shape[:2], dtype="i4") if self.causal else None
+            )
+        return super().__call__(
+            hidden_states,
+            attention_mask=attention_mask,
+            key_value_states=key_value_states,
+            position_bias=position_bias,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            deterministic=deterministic,
+            init_cache=init_cache,
+        )
+
+
+@contextlib.contextmanager
+def segment_attention():
+    """
+    Makes the T5 layers set up within the block build `FlaxT5SegmentAttention` instead of `FlaxT5Attention`, and
+    restores `FlaxT5Attention` on exit, so no other model of the process is affected. The layers look the attention
+    class up by name when they are set up, which flax does again on every `apply`, so the block has to cover the
+    applies (or their tracing under `jit`/`pmap`), see `segment_logits`. The parameters keep their names.
+    """
+    original = modeling_flax_t5.FlaxT5Attention
+    modeling_flax_t5.FlaxT5Attention = FlaxT5SegmentAttention
+    try:
+        yield
+    finally:
+        modeling_flax_t5.FlaxT5Attention = original
+
+
+def segment_masks(encoder_segment_ids, decoder_segment_ids):
+    """
+    Block attention masks of packed sequences: encoder tokens attend to the encoder tokens of their segment, decoder
+    tokens to the previous decoder tokens and to the encoder tokens of their segment. Segment 0 is padding and is
+    never attended to.
+    """
+
+    def same_segment(query_segment_ids, key_segment_ids):
+        keys = key_segment_ids[:, None, :]
+        return (query_segment_ids[:, :, None] == keys) & (keys > 0)
+
+    decoder_length = decoder_segment_ids.shape[1]
+    causal = jnp.tril(jnp.ones((decoder_length, decoder_length), dtype=bool))
+    return {
+        "attention_mask": same_segment(encoder_segment_ids, encoder_segment_ids)[
+            :, None
+        ],
+        "decoder_attention_mask": (
+            same_segment(decoder_segment_ids, decoder_segment_ids) & causal
+        )[:, None],
+        "encoder_attention_mask": same_segment(
+            decoder_segment_ids, encoder_segment_ids
+        )[:, None],
+    }
+
+
+def _segment_forward(
+    module,
+    input_ids,
+    decoder_input_ids,
+    attention_mask,
+    decoder_attention_mask,
+    encoder_attention_mask,
+    deterministic=True,
+):
+    # `FlaxT5ForConditionalGenerationModule.__call__` reuses the encoder mask for the cross-attention, block masks
+    # of the encoder and the cross-attention don't even have the same shape
+    encoder_outputs = module.encoder(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        deterministic=deterministic,
+    )
+    decoder_outputs = module.decoder(
+        input_ids=decoder_input_ids,
+        attention_mask=decoder_attention_mask,
+        encoder_hidden_states=encoder_outputs[0],
+        encoder_attention_mask=encoder_attention_mask,
+        deterministic=deterministic,
+    )
+    sequence_output = decoder_outputs[0]
+    if module.config.tie_word_embeddings:
+        sequence_output = sequence_output * (module.model_dim**-0.5)
+        shared_embedding = module.shared.variables["params"]["embedding"]
+        return module.lm_head.apply(
+            {"params": {"kernel": shared_embedding.T}}, sequence_output
+        )
+    return module.lm_head(sequence_output)
+
+
+def segment_logits(model, params, batch, dropout_rng=None, train=False):
+    """
+    Logits of the `FlaxT5ForConditionalGeneration` `model` on a batch of packed sequences, holding the `input_ids`,
+    `decoder_input_ids`, `encoder_segment_ids` and `decoder_segment_ids` of the data collator. The model is applied
+    with `segment_attention`.
+    """
+    rngs = {} if dropout_rng is None else {"dropout": dropout_rng}
+    with segment_attention():
+        return model.module.apply(
+            {"params": params},
+            input_ids=jnp.asarray(batch["input_ids"], dtype="i4"),
+            decoder_input_ids=jnp.asarray(batch["decoder_input_ids"], dtype="i4"),
+            **segment_masks(batch["encoder_segment_ids"], batch["decoder_segment_ids"]),
+            deterministic=not train,
+            rngs=rngs,
+            method=_segment_forward,
+        )
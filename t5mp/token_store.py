@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from t5mp.packing import list_column_values
+
+
+def check_replaceable(path, index_file, overwrite_flag, overwrite=False):
+    """
+    Raises unless a freshly written directory may replace `path`: it doesn't exist, it holds the `index_file` of a
+    previous write, or `overwrite` is set. Anything else may be unrelated data passed by mistake.
+    """
+    if (
+        os.path.exists(path)
+        and not overwrite
+        and not os.path.exists(os.path.join(path, index_file))
+    ):
+        raise ValueError(
+            f"{path} already exists and has no {index_file}, refusing to replace it. Pass {overwrite_flag} to"
+            " replace it anyway."
+        )
+
+
+class TokenStore:
+    """
+    Packed token sequences of one split of a token store written by `ptlm token-store`. A token store is a
+    directory holding one flat `{split}.bin` file of token ids per split, rows of `sequence_length` tokens laid out
+    back to back, and an `index.json` with the number of sequences of every split, the token dtype and the
+    preprocessing parameters the store was written with.
+
+    The `.bin` files are memory-mapped: slicing returns views of the file and `fetch` only reads the rows it
+    gathers. Pickling only carries the path, so a store can be shipped to collator worker processes.
+    """
+
+    def __init__(self, path, split="train"):
+        self.path = path
+        self.split = split
+        self.index = self.read_index(path)
+        if split not in self.index["splits"]:
+            raise ValueError(
+                f"Token store {path} has no {split} split, available splits: {list(self.index['splits'])}."
+            )
+        shape = (self.index["splits"][split], self.sequence_length)
+        if shape[0] == 0:
+            # a split shorter than one sequence has an empty file, which can't be memory-mapped
+            self.tokens = np.empty(shape, dtype=self.index["dtype"])
+        else:
+            self.tokens = np.memmap(
+                os.path.join(path, f"{split}.bin"),
+                dtype=self.index["dtype"],
+                mode="r",
+                shape=shape,
+            )
+
+    @staticmethod
+    def read_index(path):
+        with open(os.path.join(path, "index.json")) as f:
+            return json.load(f)
+
+    @classmethod
+    def load_splits(cls, path):
+        """All the splits of the token store at `path`, by name."""
+        return {split: cls(path, split) for split in cls.read_index(path)["splits"]}
+
+    @property
+    def sequence_length(self):
+        return self.index["sequence_length"]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, key):
+        return self.tokens[key]
+
+    def __getstate__(self):
+        return self.path, self.split
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def fetch(self, indices) -> np.ndarray:
+        """Rows `indices` as an int32 array, read in increasing order to stay friendly with the page cache."""
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return self.tokens[indices[order]][inverse].astype(np.int32)
+
+    @classmethod
+    def write(
+        cls,
+        path,
+        datasets,
+        sequence_length,
+        vocab_size,
+        column="input_ids",
+        overwrite=False,
+        **params,
+    ):
+        """
+        Writes the `column` of the packed `datasets` (a mapping of split names to datasets of rows of
+        `sequence_length` tokens) to a token store at `path`, see `write_sequences`.
+        """
+        return cls.write_sequences(
+            path,
+            {
+                split: (
+                    list_column_values(chunk)
+                    for chunk in dataset.data.column(column).chunks
+                )
+                for split, dataset in datasets.items()
+            },
+            sequence_length,
+            vocab_size,
+            overwrite=overwrite,
+            **params,
+        )
+
+    @classmethod
+    def write_sequences(
+        cls, path, splits, sequence_length, vocab_size, overwrite=False, **params
+    ):
+        """
+        Writes a token store at `path` from `splits`, a mapping of split names to iterables of arrays of packed token
+        ids, each holding a whole number of rows of `sequence_length` tokens. Token ids are stored as uint16 when
+        `vocab_size` allows it. `params` are recorded in the index next to the layout of the store. The store is
+        written next to `path` first and moved in place once complete. An existing directory at `path` is only
+        replaced if it is a token store or with `overwrite`, see `check_replaceable`.
+        """
+        check_replaceable(path, "index.json", "--overwrite_token_store", overwrite)
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+        num_sequences = {}
+        for split, sequences in splits.items():
+            num_tokens = 0
+            with open(os.path.join(tmp_path, f"{split}.bin"), "wb") as f:
+                for values in sequences:
+                    f.write(np.asarray(values, dtype=dtype).tobytes())
+                    num_tokens += values.size
+            num_sequences[split] = num_tokens // sequence_length
+
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "sequence_length": sequence_length,
+                    "dtype": np.dtype(dtype).name,
+                    "vocab_size": vocab_size,
+                    "splits": num_sequences,
+                    **params,
+                },
+                f,
+                indent=4,
+            )
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        return cls.load_splits(path)
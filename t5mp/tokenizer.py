@@ -10,14 +10,24 @@ from t5mp.t5_tokenizer_model import SentencePieceUnigramTokenizer
 @click.option("--name", default="t5mumo")
 @click.option("--dataset-name", default="wikitext")
 @click.option("--dataset-config-name", default="wikitext-103-v1")
-def train_tokenizer(vocab_size, name, dataset_name, dataset_config_name):
+@click.option(
+    "--train-file",
+    default=None,
+    help="Text file or glob pattern of text files to train on instead of the dataset, e.g. the output of `ptlm dedup`.",
+)
+def train_tokenizer(vocab_size, name, dataset_name, dataset_config_name, train_file):
     os.makedirs(f"./{name}", exist_ok=True)
     input_sentence_size = None
 
     # Initialize a dataset
-    dataset = datasets.load_dataset(
-        dataset_name, name=dataset_config_name, split="train"
-    )
+    if train_file is not None:
+        dataset = datasets.load_dataset(
+            "text", data_files={"train": train_file}, split="train"
+        )
+    else:
+        dataset = datasets.load_dataset(
+            dataset_name, name=dataset_config_name, split="train"
+        )
 
     tokenizer = SentencePieceUnigramTokenizer(
         unk_token="<unk>", eos_token="</s>", pad_token="<pad>"
@@ -0,0 +1,33 @@
+from click.testing import CliRunner
+
+from t5mp import benchmark
+
+
+class Tokenizer:
+    """The only parts of a tokenizer the collator benchmark uses."""
+
+    pad_token_id = 0
+    eos_token_id = 1
+
+    def __len__(self):
+        return 1000
+
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+
+def test_benchmark_collator_runs_every_case(monkeypatch):
+    monkeypatch.setattr(benchmark, "AutoTokenizer", Tokenizer)
+    args = ["collator", "--batch-sizes", "2", "--seq-lengths", "32", "--repeats", "1"]
+    result = CliRunner().invoke(benchmark.benchmark, args)
+    assert result.exit_code == 0, result.output
+    for case in (
+        "random_spans_noise_mask_batch",
+        "create_sentinel_ids",
+        "filter_input_ids",
+        "create_inputs_and_labels",
+        "shift_tokens_right",
+        "__call__",
+    ):
+        assert case in result.output
@@ -0,0 +1,19 @@
+from click.testing import CliRunner
+
+from t5mp.main import cli
+
+
+def test_cli_lists_every_command():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0, result.output
+    for command in (
+        "config",
+        "dedup",
+        "tokenizer",
+        "train-model",
+        "token-store",
+        "pre-mask",
+        "profile-corpus",
+        "benchmark",
+    ):
+        assert command in result.output
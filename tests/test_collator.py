@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from t5mp.input_pipeline import noise_rng_key
+from t5mp.run_t5_mlm_flax import (
+    FlaxDataCollatorForT5MLM,
+    compute_input_and_target_lengths,
+)
+
+
+class Tokenizer:
+    """The only parts of a tokenizer the collator uses: the vocabulary size and the EOS token."""
+
+    eos_token_id = 1
+
+    def __len__(self):
+        return 32100
+
+
+def make_collator(input_length=128, noise_density=0.15, mean_noise_span_length=3.0):
+    expanded_inputs_length, target_length = compute_input_and_target_lengths(
+        inputs_length=input_length,
+        noise_density=noise_density,
+        mean_noise_span_length=mean_noise_span_length,
+    )
+    collator = FlaxDataCollatorForT5MLM(
+        tokenizer=Tokenizer(),
+        noise_density=noise_density,
+        mean_noise_span_length=mean_noise_span_length,
+        input_length=input_length,
+        target_length=target_length,
+        pad_token_id=0,
+        decoder_start_token_id=0,
+    )
+    return collator, expanded_inputs_length
+
+
+def span_counts(mask):
+    return np.sum(mask[:, 1:] & ~mask[:, :-1], axis=-1) + mask[:, 0]
+
+
+@pytest.mark.parametrize("input_length", [64, 128, 512])
+def test_batched_noise_masks_match_per_row_masks(input_length):
+    collator, length = make_collator(input_length)
+    np.random.seed(0)
+    batch = collator.random_spans_noise_mask_batch(64, length)
+    rows = np.stack([collator.random_spans_noise_mask(length) for _ in range(64)])
+    assert batch.shape == rows.shape == (64, length)
+    # same number of noise tokens and of noise spans in every row, the last token is always noise
+    np.testing.assert_array_equal(batch.sum(axis=-1), rows.sum(axis=-1))
+    np.testing.assert_array_equal(span_counts(batch), span_counts(rows))
+    assert batch[:, -1].all() and rows[:, -1].all()
+    # the spans are random: rows differ and every position gets noise in some row
+    assert len(np.unique(batch, axis=0)) > 1
+    assert batch[:, :-1].any(axis=0).mean() > 0.9
+
+
+def test_fused_inputs_and_labels_match_sentinel_filtering():
+    collator, length = make_collator(128)
+    rng = np.random.RandomState(0)
+    input_ids = rng.randint(2, 32000, size=(32, length)).astype(np.int32)
+    mask = collator.random_spans_noise_mask_batch(
+        32, length, rng_key=noise_rng_key(0, 0, 0)
+    )
+
+    out = collator.create_inputs_and_labels(input_ids, mask)
+    expected_inputs = collator.filter_input_ids(
+        input_ids, collator.create_sentinel_ids(mask.astype(np.int8))
+    )
+    expected_labels = collator.filter_input_ids(
+        input_ids, collator.create_sentinel_ids((~mask).astype(np.int8))
+    )
+    np.testing.assert_array_equal(out["input_ids"], expected_inputs)
+    np.testing.assert_array_equal(out["labels"], expected_labels)
+    np.testing.assert_array_equal(
+        out["decoder_input_ids"][:, 1:], out["labels"][:, :-1]
+    )
+    np.testing.assert_array_equal(out["decoder_input_ids"][:, 0], 0)
+
+    # the index maps of a mask bank give the same batch
+    mapped = collator.apply_index_maps(input_ids, collator.create_index_maps(mask))
+    for name in ("input_ids", "labels", "decoder_input_ids"):
+        np.testing.assert_array_equal(mapped[name], out[name])
+
+
+def test_keyed_masks_only_depend_on_their_row():
+    collator, length = make_collator(128)
+    key = noise_rng_key(7, 1, 3)
+    full = collator.random_spans_noise_mask_batch(16, length, rng_key=key)
+    tail = collator.random_spans_noise_mask_batch(6, length, rng_key=key, row_offset=10)
+    np.testing.assert_array_equal(tail, full[10:])
+    other = collator.random_spans_noise_mask_batch(
+        16, length, rng_key=noise_rng_key(7, 1, 4)
+    )
+    assert not np.array_equal(full, other)
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+
+from t5mp.input_pipeline import CollatorPool
+
+
+class Collator:
+    """Writes the gathered rows into the slot, shapes are those of a collator of `input_length` tokens."""
+
+    input_length = 4
+    target_length = 2
+
+    def __call__(self, input_ids, out, rng_key, row_offset):
+        out["input_ids"][:] = input_ids
+        out["labels"][:] = input_ids[:, :2]
+        out["decoder_input_ids"][:] = input_ids[:, 2:]
+
+
+class CrashingCollator(Collator):
+    """Kills its worker process like the OS would on running out of memory."""
+
+    def __call__(self, input_ids, out, rng_key, row_offset):
+        os._exit(1)
+
+
+def test_collator_pool_yields_batches_in_order():
+    dataset = np.arange(80, dtype=np.int32).reshape((20, 4))
+    batch_idx = [np.arange(start, start + 4) for start in range(0, 20, 4)]
+    with CollatorPool(dataset, Collator(), 4, num_workers=2, ring_size=2) as pool:
+        for batch, idx in zip(pool.iterate(batch_idx), batch_idx):
+            np.testing.assert_array_equal(batch["input_ids"], dataset[idx])
+
+
+def test_collator_pool_raises_when_a_worker_dies():
+    dataset = np.zeros((8, 4), dtype=np.int32)
+    batch_idx = [np.arange(4), np.arange(4, 8)]
+    with CollatorPool(dataset, CrashingCollator(), 4, num_workers=1) as pool:
+        with pytest.raises(RuntimeError, match="exit code 1"):
+            list(pool.iterate(batch_idx))
@@ -0,0 +1,91 @@
+import json
+import random
+
+import numpy as np
+from click.testing import CliRunner
+
+from t5mp.dedup import MinHasher, dedup, duplicate_masks, exact_hash
+
+
+def random_document(rng, num_words):
+    return " ".join(f"w{rng.randrange(100000)}" for _ in range(num_words))
+
+
+def test_exact_hash_normalizes_whitespace():
+    assert exact_hash("a  b\tc ") == exact_hash("a b c")
+    assert exact_hash("a b c") != exact_hash("a b d")
+
+
+def test_minhasher_bands_catch_near_duplicates_only():
+    rng = random.Random(0)
+    hasher = MinHasher(num_perm=128, bands=16, ngram=5)
+    document = random_document(rng, 200)
+    words = document.split()
+    words[100] = "edited"
+    near = " ".join(words)
+    other = random_document(rng, 200)
+    signatures, has_ngrams = hasher.signatures([document, near, other, "too short"])
+    np.testing.assert_array_equal(has_ngrams, [True, True, True, False])
+
+    keys = hasher.band_keys(signatures[:3])
+    assert np.any(keys[0] == keys[1])
+    assert not np.any(keys[0] == keys[2])
+    # the signature of a document doesn't depend on the batch it is hashed with
+    np.testing.assert_array_equal(hasher.signatures([near])[0][0], signatures[1])
+
+
+def test_duplicate_masks():
+    ids = np.array([(1 << 40) + 2, 0, (2 << 40) + 0, 3], dtype=np.uint64)
+    masks = duplicate_masks(ids, [4, 3, 1])
+    assert [mask.tolist() for mask in masks] == [
+        [True, False, False, True],
+        [False, False, True],
+        [True],
+    ]
+
+
+def test_dedup_removes_exact_and_near_duplicates(tmp_path):
+    rng = random.Random(0)
+    originals = [random_document(rng, 50) for _ in range(20)]
+    near = originals[3].split()
+    near[25] = "edited"
+    shards = [
+        originals[:10] + [originals[0]],
+        originals[10:] + ["  ".join(originals[5].split()), " ".join(near)],
+    ]
+    inputs = []
+    for shard, documents in enumerate(shards):
+        path = tmp_path / f"input-{shard}.txt"
+        path.write_text("".join(document + "\n" for document in documents))
+        inputs += ["--input", str(path)]
+
+    output_dir = tmp_path / "dedup"
+    args = inputs + ["--output-dir", str(output_dir), "--num-partitions", "4"]
+    result = CliRunner().invoke(dedup, args + ["--num-workers", "2"])
+    assert result.exit_code == 0, result.output
+
+    kept = [
+        line
+        for shard in range(2)
+        for line in (output_dir / f"shard-{shard:05d}.txt").read_text().splitlines()
+    ]
+    assert kept == originals
+    stats = json.loads((output_dir / "dedup_stats.json").read_text())
+    assert stats["documents"] == {
+        "total": 23,
+        "exact_duplicates": 2,
+        "near_duplicates": 1,
+        "kept": 20,
+    }
+    assert stats["words"]["exact_duplicates"] == 100
+
+    # the output of a previous run is replaced, anything else only with --overwrite
+    result = CliRunner().invoke(dedup, args + ["--num-workers", "1"])
+    assert result.exit_code == 0, result.output
+    other_dir = tmp_path / "corpus"
+    other_dir.mkdir()
+    (other_dir / "data.txt").write_text("precious\n")
+    args = inputs + ["--output-dir", str(other_dir), "--num-partitions", "4"]
+    result = CliRunner().invoke(dedup, args)
+    assert isinstance(result.exception, ValueError)
+    assert (other_dir / "data.txt").exists()
@@ -0,0 +1,108 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from t5mp.packing import (
+    StreamingPacker,
+    bucket_chunk_starts,
+    bucket_dropped_tokens,
+    count_tokens,
+    list_column_lengths,
+)
+
+
+def random_documents(rng, num_documents, max_length=50):
+    return [
+        rng.randint(0, 1000, size=rng.randint(0, max_length)).tolist()
+        for _ in range(num_documents)
+    ]
+
+
+def test_count_tokens_and_lengths_of_sliced_chunks():
+    column = pa.chunked_array(
+        [
+            pa.array([[1, 2], [3], [], [4, 5, 6]]).slice(1, 3),
+            pa.array([[7]]).slice(1, 0),
+            pa.array([[8, 9]]),
+        ]
+    )
+    assert count_tokens(column) == 6
+    assert list_column_lengths(column).tolist() == [1, 0, 3, 2]
+
+
+@pytest.mark.parametrize("length", [1, 7, 64])
+def test_streaming_packer_is_lossless(length):
+    rng = np.random.RandomState(length)
+    documents = random_documents(rng, 200)
+    packer = StreamingPacker(length)
+    rows = []
+    for start in range(0, len(documents), 17):
+        table = pa.table({"input_ids": documents[start : start + 17]})
+        packed = packer(table)["input_ids"]
+        assert packed.shape[1:] == (length,)
+        rows.append(packed.reshape(-1))
+
+    stream = np.concatenate([np.asarray(document) for document in documents])
+    packed = np.concatenate(rows + [packer.remainder["input_ids"]])
+    np.testing.assert_array_equal(packed, stream)
+    assert len(packer.remainder["input_ids"]) < length
+    assert packer.tokens_seen == len(stream)
+    assert packer.tokens_packed == len(stream) - len(packer.remainder["input_ids"])
+
+
+def test_streaming_packer_segment_ids_follow_documents():
+    rng = np.random.RandomState(0)
+    documents = random_documents(rng, 100, max_length=20)
+    length = 16
+    packer = StreamingPacker(length, segment_ids=True)
+    segment_ids = []
+    for start in range(0, len(documents), 10):
+        result = packer(pa.table({"input_ids": documents[start : start + 10]}))
+        segment_ids.append(result["segment_ids"])
+    segment_ids = np.concatenate(segment_ids)
+
+    document_of_token = np.repeat(np.arange(len(documents)), list(map(len, documents)))
+    document_of_token = document_of_token[: segment_ids.size].reshape(segment_ids.shape)
+    # segments are renumbered from 1 in every row and change exactly where the document does
+    np.testing.assert_array_equal(segment_ids[:, 0], 1)
+    np.testing.assert_array_equal(
+        np.diff(segment_ids, axis=1) > 0, np.diff(document_of_token, axis=1) > 0
+    )
+
+
+def test_bucket_chunk_starts_never_span_documents():
+    rng = np.random.RandomState(0)
+    document_lengths = rng.randint(0, 300, size=100)
+    lengths = [32, 128, 64]
+    starts = bucket_chunk_starts(document_lengths, lengths)
+    ends = np.cumsum(document_lengths)
+    covered = np.zeros(ends[-1], dtype=np.int64)
+    for bucket_starts, length in zip(starts, lengths):
+        documents = np.searchsorted(ends, bucket_starts, side="right")
+        assert np.all(bucket_starts + length <= ends[documents])
+        for start in bucket_starts:
+            covered[start : start + length] += 1
+    assert covered.max() <= 1
+    # less than the shortest bucket is dropped per document
+    kept = np.array(
+        [covered[end - n : end].sum() for n, end in zip(document_lengths, ends)]
+    )
+    assert np.all(document_lengths - kept < min(lengths))
+
+
+def test_bucket_dropped_tokens_are_those_left_out_of_chunks():
+    rng = np.random.RandomState(1)
+    document_lengths = rng.randint(0, 300, size=100)
+    lengths = [48, 128, 64]
+    dropped = bucket_dropped_tokens(document_lengths, lengths)
+    num_chunked = sum(
+        len(bucket_starts) * length
+        for bucket_starts, length in zip(
+            bucket_chunk_starts(document_lengths, lengths), lengths
+        )
+    )
+    assert dropped.sum() == document_lengths.sum() - num_chunked
+    # documents shorter than the shortest bucket are dropped whole
+    short = document_lengths < min(lengths)
+    np.testing.assert_array_equal(dropped[short], document_lengths[short])
+    assert np.all(dropped[~short] < min(lengths))
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from t5mp.sampling import (
+    BlockShufflePermutation,
+    FeistelPermutation,
+    LazyBatchSplits,
+    WeightedMixtureBatchSplits,
+)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 17, 1000, 4097])
+def test_feistel_permutation_is_a_bijection(size):
+    permutation = FeistelPermutation(size, seed=[0, 1])
+    values = permutation[np.arange(size)]
+    np.testing.assert_array_equal(np.sort(values), np.arange(size))
+    assert permutation[size - 1] == values[-1]
+
+
+def test_feistel_permutation_depends_on_the_seed():
+    first = FeistelPermutation(1000, seed=[0, 0])[np.arange(1000)]
+    second = FeistelPermutation(1000, seed=[0, 1])[np.arange(1000)]
+    assert not np.array_equal(first, second)
+    with pytest.raises(IndexError):
+        FeistelPermutation(1000, seed=0)[1000]
+
+
+@pytest.mark.parametrize(
+    "size,block_size,window_blocks", [(1000, 16, 4), (1000, 7, 3), (10, 16, 4)]
+)
+def test_block_shuffle_permutation_is_a_bijection(size, block_size, window_blocks):
+    permutation = BlockShufflePermutation(size, block_size, window_blocks, seed=3)
+    values = permutation[np.arange(size)]
+    np.testing.assert_array_equal(np.sort(values), np.arange(size))
+
+
+def test_block_shuffle_windows_read_few_blocks():
+    block_size, window_blocks = 64, 8
+    permutation = BlockShufflePermutation(100000, block_size, window_blocks, seed=0)
+    batch = permutation[np.arange(512, 1024)]
+    assert len(np.unique(batch // block_size)) <= window_blocks
+
+
+def test_lazy_batch_splits_partition_the_permutation_between_hosts():
+    permutation = FeistelPermutation(103, seed=0)
+    hosts = [LazyBatchSplits(permutation, 20, num_hosts=2, host=h) for h in range(2)]
+    assert len(hosts[0]) == 5
+    rows = np.concatenate([np.concatenate(list(host)) for host in hosts])
+    assert len(np.unique(rows)) == len(rows) == 100
+
+
+def test_mixture_meets_its_weights():
+    weights = [0.5, 0.3, 0.2]
+    batch_size, num_steps = 64, 50
+    mixture = WeightedMixtureBatchSplits(
+        [1000, 100, 7], weights, batch_size, num_steps, seed=0
+    )
+    counts = np.zeros(len(weights), dtype=np.int64)
+    for sources, rows in mixture:
+        batch_counts = np.bincount(sources, minlength=len(weights))
+        # every batch is within one row of the weights
+        assert np.all(np.abs(batch_counts - batch_size * np.array(weights)) <= 1)
+        counts += batch_counts
+    np.testing.assert_array_equal(counts, mixture.rows_drawn(num_steps))
+    np.testing.assert_allclose(counts / counts.sum(), weights, atol=1 / counts.sum())
+
+
+def test_mixture_reads_every_row_of_a_source_once_per_pass():
+    size = 100
+    mixture = WeightedMixtureBatchSplits([size, 10000], [0.25, 0.75], 40, 10, seed=1)
+    rows = np.concatenate(
+        [rows[sources == 0] for sources, rows in map(mixture.batch, range(10))]
+    )
+    assert len(rows) == size
+    np.testing.assert_array_equal(np.sort(rows), np.arange(size))
+
+
+def test_mixture_hosts_split_a_shuffled_global_batch():
+    sizes, weights, batch_size = [1000, 1000], [0.7, 0.3], 8
+    hosts = [
+        WeightedMixtureBatchSplits(
+            sizes, weights, batch_size, 200, seed=0, num_hosts=2, host=host
+        )
+        for host in range(2)
+    ]
+    full = WeightedMixtureBatchSplits(sizes, weights, batch_size, 200, seed=0)
+    host_counts = np.zeros((2, 2), dtype=np.int64)
+    for step in range(200):
+        sources, rows = full.batch(step)
+        local = [host.batch(step) for host in hosts]
+        pairs = sorted(zip(sources.tolist(), rows.tolist()))
+        local_pairs = sorted(
+            pair
+            for host_sources, host_rows in local
+            for pair in zip(host_sources.tolist(), host_rows.tolist())
+        )
+        assert local_pairs == pairs
+        for host, (host_sources, _) in enumerate(local):
+            host_counts[host] += np.bincount(host_sources, minlength=2)
+    # both hosts see the sources at the weights, not one source each
+    shares = host_counts / host_counts.sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(shares, [weights, weights], atol=0.05)
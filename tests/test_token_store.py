@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+from t5mp.token_store import TokenStore
+
+
+def write(path, sequences, **kwargs):
+    return TokenStore.write_sequences(
+        str(path), {"train": [sequences]}, sequences.shape[1], 1000, **kwargs
+    )
+
+
+def test_write_sequences_round_trip(tmp_path):
+    sequences = np.arange(60).reshape((6, 10))
+    store = write(tmp_path / "store", sequences)["train"]
+    assert len(store) == 6
+    np.testing.assert_array_equal(store.fetch([4, 0, 5]), sequences[[4, 0, 5]])
+
+
+def test_empty_splits_load(tmp_path):
+    sequences = np.arange(20).reshape((2, 10))
+    splits = {"train": [sequences], "validation": [sequences[:0]]}
+    store = TokenStore.write_sequences(str(tmp_path / "store"), splits, 10, 1000)
+    assert len(store["validation"]) == 0
+    assert store["validation"].fetch(np.arange(0)).shape == (0, 10)
+    reloaded = TokenStore.load_splits(str(tmp_path / "store"))
+    assert len(reloaded["validation"]) == 0
+    np.testing.assert_array_equal(reloaded["train"].fetch([1]), sequences[[1]])
+
+
+def test_write_replaces_a_token_store(tmp_path):
+    write(tmp_path / "store", np.zeros((2, 4), dtype=np.int64))
+    store = write(tmp_path / "store", np.ones((3, 4), dtype=np.int64))["train"]
+    assert len(store) == 3
+
+
+def test_write_refuses_to_replace_other_directories(tmp_path):
+    path = tmp_path / "checkpoint"
+    path.mkdir()
+    (path / "weights").write_text("precious")
+    with pytest.raises(ValueError, match="--overwrite_token_store"):
+        write(path, np.zeros((2, 4), dtype=np.int64))
+    assert (path / "weights").read_text() == "precious"
+
+    write(path, np.zeros((2, 4), dtype=np.int64), overwrite=True)
+    assert not os.path.exists(path / "weights")
@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from t5mp.run_t5_mlm_flax import load_token_store_mixture
+from t5mp.token_store import TokenStore
+
+
+class Tokenizer:
+    def __len__(self):
+        return 1000
+
+
+def write(path, num_train, num_validation):
+    sequences = np.arange((num_train + num_validation) * 8).reshape((-1, 8)) % 1000
+    splits = {"train": [sequences[:num_train]], "validation": [sequences[num_train:]]}
+    TokenStore.write_sequences(str(path), splits, 8, 1000)
+    return str(path)
+
+
+def test_mixture_skips_stores_without_validation_sequences(tmp_path):
+    first = write(tmp_path / "first", 10, 0)
+    second = write(tmp_path / "second", 10, 3)
+    data_args = SimpleNamespace(token_store_mixture=f"{first}:0.5,{second}:0.5")
+    stores, weights = load_token_store_mixture(data_args, Tokenizer(), 8)
+    assert [len(store["validation"]) for store in stores] == [0, 3]
+    assert weights == [0.5, 0.5]
+
+
+def test_mixture_needs_a_validation_sequence(tmp_path):
+    first = write(tmp_path / "first", 10, 0)
+    second = write(tmp_path / "second", 10, 0)
+    data_args = SimpleNamespace(token_store_mixture=f"{first}:0.5,{second}:0.5")
+    with pytest.raises(ValueError, match="validation split"):
+        load_token_store_mixture(data_args, Tokenizer(), 8)